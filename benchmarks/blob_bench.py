@@ -0,0 +1,368 @@
+"""
+Offline replay benchmark for BlobPlugin's submission and voting flow.
+
+Drives a real BlobPlugin against a stub Discord client/API (with optional
+simulated API latency) and a temporary SQLite database, replaying synthetic
+MessageCreate, MessageReactionAdd/Remove and MessageDelete streams at a given
+concurrency. Reports events/sec, p50/p99 handler latency and vote lock wait
+time per handler, so changes to the submission path can be compared run over
+run (use --json to save results).
+
+    python benchmarks/blob_bench.py --submissions 200 --reactions 5000 --concurrency 50
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+import gevent
+
+from StringIO import StringIO
+from collections import defaultdict
+from gevent.pool import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image
+from disco.gateway.events import MessageCreate, MessageReactionAdd, MessageReactionRemove, MessageDelete
+
+from plugins import blob
+
+
+class Snowflakes(object):
+    def __init__(self, start=400000000000000000):
+        self.value = start
+
+    def __call__(self):
+        self.value += 1
+        return self.value
+
+
+next_id = Snowflakes()
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class StubAPI(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = defaultdict(int)
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            gevent.sleep(random.expovariate(1.0 / self.latency))
+
+    def guilds_emojis_create(self, guild, name=None, roles=None, image=None):
+        self._call('guilds_emojis_create')
+        return StubEmoji(next_id(), name)
+
+    def guilds_emojis_delete(self, guild, emoji):
+        self._call('guilds_emojis_delete')
+
+    def guilds_emojis_modify(self, guild, emoji, **kwargs):
+        self._call('guilds_emojis_modify')
+
+    def channels_messages_reactions_get(self, channel, message, emoji, after=None, limit=100):
+        self._call('channels_messages_reactions_get')
+        return []
+
+
+class StubEmoji(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+    def __str__(self):
+        return '<:{}:{}>'.format(self.name, self.id)
+
+
+class StubMessage(object):
+    def __init__(self, api, channel_id, content=None):
+        self.api = api
+        self.id = next_id()
+        self.channel_id = channel_id
+        self.content = content
+
+    def add_reaction(self, emoji):
+        self.api._call('channels_messages_reactions_create')
+
+
+class StubChannel(object):
+    def __init__(self, api, guild_id):
+        self.api = api
+        self.id = next_id()
+        self.guild_id = guild_id
+        self.messages = []
+
+    def send_message(self, content=None, **kwargs):
+        self.api._call('channels_messages_create')
+        msg = StubMessage(self.api, self.id, content)
+        self.messages.append(msg.id)
+        return msg
+
+    def delete_message(self, message):
+        self.api._call('channels_messages_delete')
+
+
+class StubUser(object):
+    def __init__(self, api, id):
+        self.api = api
+        self.id = id
+
+    def chain(self, *args):
+        return self
+
+    def open_dm(self):
+        return StubChannel(self.api, None)
+
+    def __str__(self):
+        return 'user#{}'.format(self.id)
+
+
+class StubCtx(dict):
+    def drop(self):
+        self.clear()
+
+
+class StubEmitter(object):
+    def on(self, *args, **kwargs):
+        return Obj(remove=lambda: None)
+
+
+def stub_event(cls, **kwargs):
+    """
+    Builds an instance of a real disco event class (so isinstance checks in
+    the plugin behave) without going through its model loading. Attributes
+    are set on a throwaway subclass, as some of them are properties on the
+    real event classes.
+    """
+    attrs = {
+        key: staticmethod(value) if callable(value) else value
+        for key, value in kwargs.items()
+    }
+    stub_cls = type(cls.__name__, (cls, ), attrs)
+    return stub_cls.__new__(stub_cls)
+
+
+class Recorder(object):
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock_waits = defaultdict(list)
+        self.current = None
+
+    @contextlib.contextmanager
+    def timed_lock(self, lock):
+        start = time.time()
+        with lock:
+            self.lock_waits[self.current].append(time.time() - start)
+            yield
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+
+def make_images(count, size=64):
+    images = []
+    for _ in range(count):
+        img = Image.new('RGBA', (size, size))
+        img.putdata([
+            tuple(random.randint(0, 255) for _ in range(3)) + (255, )
+            for _ in range(size * size)])
+        buff = StringIO()
+        img.save(buff, 'PNG')
+        images.append(buff.getvalue())
+    return images
+
+
+class Harness(object):
+    def __init__(self, args):
+        self.args = args
+        self.api = StubAPI(args.api_latency)
+        self.recorder = Recorder()
+
+        self.guild = Obj(id=next_id())
+        me = StubUser(self.api, next_id())
+        channels = {}
+        self.config = blob.BlobPluginConfig()
+        for key in ('suggestion_channel', 'council_queue_channel', 'council_changelog_channel',
+                    'approval_queue_channel'):
+            channel = StubChannel(self.api, self.guild.id)
+            channels[channel.id] = channel
+            setattr(self.config, key, channel.id)
+        self.config.vote_flush_interval = args.flush_interval
+        self.config.database = os.path.join(os.getcwd(), 'emojis.db')
+        self.channels = channels
+
+        state = Obj(me=me, channels=channels, users={})
+        client = Obj(api=self.api, state=state, events=StubEmitter(), packets=StubEmitter())
+        bot = Obj(client=client, ctx=StubCtx(), storage=None)
+
+        self.plugin = blob.BlobPlugin(bot, self.config)
+        self.plugin.load({})
+
+        # Serve attachments from memory rather than the network
+        self.images = {}
+        self.plugin.pipeline.fetch = lambda url: self.images[url]
+
+        # Measure how long handlers wait on the per-submission vote locks
+        votes = self.plugin.votes
+        original_lock = votes.lock
+        votes.lock = lambda sid: self.recorder.timed_lock(original_lock(sid))
+
+        self.voters = [StubUser(self.api, next_id()) for _ in range(args.voters)]
+        self.authors = [StubUser(self.api, next_id()) for _ in range(max(1, args.submissions // 4))]
+
+    @property
+    def suggestion(self):
+        return self.channels[self.config.suggestion_channel]
+
+    def submission_events(self):
+        images = make_images(self.args.submissions)
+        for idx, raw in enumerate(images):
+            url = 'https://cdn.example/{}.png'.format(idx)
+            self.images[url] = raw
+            yield stub_event(
+                MessageCreate,
+                id=next_id(),
+                author=random.choice(self.authors),
+                channel=self.suggestion,
+                guild=self.guild,
+                content=':blob_{}:'.format(idx),
+                attachments={idx: Obj(url=url)},
+                delete=lambda: None)
+
+    def reaction_events(self):
+        msgs = [msg for msg in self.plugin.queue_msgs.keys()]
+        if not msgs:
+            return
+
+        for _ in range(self.args.reactions):
+            cls = MessageReactionAdd if random.random() > self.args.remove_ratio else MessageReactionRemove
+            emoji = blob.GREEN_TICK_ID if random.random() > 0.4 else blob.RED_TICK_ID
+            yield stub_event(
+                cls,
+                user_id=random.choice(self.voters).id,
+                channel_id=self.config.council_queue_channel,
+                message_id=random.choice(msgs),
+                emoji=Obj(id=emoji))
+
+    def delete_events(self):
+        live = list(self.plugin.queue_msgs.keys())
+        for _ in range(self.args.deletes):
+            if live and random.random() < self.args.delete_hit_ratio:
+                msg_id = live.pop(random.randrange(len(live)))
+            else:
+                msg_id = next_id()
+            yield stub_event(MessageDelete, id=msg_id, channel_id=self.config.council_queue_channel)
+
+    def replay(self, name, handler, events):
+        self.recorder.current = name
+        samples = self.recorder.samples[name]
+
+        def run(event):
+            start = time.time()
+            handler(event)
+            samples.append(time.time() - start)
+
+        pool = Pool(self.args.concurrency)
+        start = time.time()
+        for event in events:
+            pool.spawn(run, event)
+        pool.join()
+        return time.time() - start
+
+    def run(self):
+        results = {}
+        phases = [
+            ('on_message_create', self.plugin.on_message_create, self.submission_events),
+            ('on_message_reaction_add', self.plugin.on_message_reaction_add, self.reaction_events),
+            ('on_message_delete', self.plugin.on_message_delete, self.delete_events),
+        ]
+
+        for name, handler, events in phases:
+            duration = self.replay(name, handler, events())
+            samples = self.recorder.samples[name]
+            waits = self.recorder.lock_waits[name]
+            results[name] = {
+                'events': len(samples),
+                'events_per_sec': len(samples) / duration if duration else 0,
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+                'lock_wait_p50_ms': percentile(waits, 50) * 1000,
+                'lock_wait_p99_ms': percentile(waits, 99) * 1000,
+            }
+
+        self.plugin.unload({})
+        results['api_calls'] = dict(self.api.calls)
+        return results
+
+
+def print_results(results):
+    fmt = '{:<26}{:>8}{:>12}{:>10}{:>10}{:>14}{:>14}'
+    print(fmt.format('Handler', 'Events', 'Events/s', 'p50 ms', 'p99 ms', 'Lock p50 ms', 'Lock p99 ms'))
+    for name in ('on_message_create', 'on_message_reaction_add', 'on_message_delete'):
+        row = results[name]
+        print(fmt.format(
+            name,
+            row['events'],
+            '{:.1f}'.format(row['events_per_sec']),
+            '{:.3f}'.format(row['p50_ms']),
+            '{:.3f}'.format(row['p99_ms']),
+            '{:.3f}'.format(row['lock_wait_p50_ms']),
+            '{:.3f}'.format(row['lock_wait_p99_ms'])))
+
+    print('\nAPI calls: ' + ', '.join('{}={}'.format(k, v) for k, v in sorted(results['api_calls'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--submissions', type=int, default=100)
+    parser.add_argument('--reactions', type=int, default=2000)
+    parser.add_argument('--deletes', type=int, default=2000)
+    parser.add_argument('--voters', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=25)
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='mean simulated Discord API latency in seconds')
+    parser.add_argument('--remove-ratio', type=float, default=0.1)
+    parser.add_argument('--delete-hit-ratio', type=float, default=0.05,
+                        help='fraction of deletes that hit a live queue message')
+    parser.add_argument('--flush-interval', type=float, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='blob-bench-')
+    try:
+        os.chdir(workdir)
+        results = Harness(args).run()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Startup benchmark for the bot's plugins.
+
+Imports each plugin module in a fresh interpreter (after disco and gevent, which
+every plugin pays for anyway), then constructs, load()s and unload()s its
+plugins against a stub bot, reporting the median import/load/unload time and
+how many modules the import pulled in. Use it to keep cold start and reloads
+cheap (use --json to save results).
+
+    python benchmarks/startup_bench.py
+    python benchmarks/startup_bench.py blob torrent --repeat 10
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import shutil
+import inspect
+import argparse
+import tempfile
+import importlib
+import subprocess
+
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from disco.bot import Plugin, Config
+
+
+# Modules in plugins/ which only hold helpers for the plugins
+HELPER_MODULES = ('instrument', 'memory', 'metrics', 'monitor', 'submissions', 'timeseries')
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class StubCtx(dict):
+    def drop(self):
+        self.clear()
+
+
+class StubEmitter(object):
+    def on(self, *args, **kwargs):
+        return Obj(remove=lambda: None, callback=None)
+
+
+def stub_bot():
+    state = Obj(me=None, guilds={}, channels={}, users={}, messages=defaultdict(list))
+    client = Obj(
+        api=None,
+        state=state,
+        events=StubEmitter(),
+        packets=StubEmitter(),
+        config=Obj(shard_id=0))
+    return Obj(client=client, ctx=StubCtx(), storage=None, plugins={}, shards=None)
+
+
+def plugin_modules():
+    names = []
+    for filename in sorted(os.listdir(os.path.join(ROOT, 'plugins'))):
+        name, ext = os.path.splitext(filename)
+        if ext == '.py' and name != '__init__' and name not in HELPER_MODULES:
+            names.append(name)
+    return names
+
+
+def measure(name):
+    """
+    Runs in the child interpreter, measuring a single plugin module.
+    """
+    result = {'import': 0, 'modules': 0, 'load': 0, 'unload': 0, 'error': None}
+
+    before = len(sys.modules)
+    start = time.time()
+    module = importlib.import_module('plugins.' + name)
+    result['import'] = time.time() - start
+    result['modules'] = len(sys.modules) - before
+
+    bot = stub_bot()
+    for cls in vars(module).values():
+        if not inspect.isclass(cls) or not issubclass(cls, Plugin) or cls.__module__ != module.__name__:
+            continue
+
+        try:
+            plugin = cls(bot, getattr(cls, 'config_cls', Config)())
+
+            start = time.time()
+            plugin.load({})
+            result['load'] += time.time() - start
+            bot.plugins[plugin.name] = plugin
+
+            start = time.time()
+            plugin.unload({})
+            result['unload'] += time.time() - start
+        except Exception as e:
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+
+    return result
+
+
+def run_child(name):
+    """
+    Measures a plugin module in a fresh interpreter, from a scratch directory
+    (some plugins create their databases in the working directory).
+    """
+    workdir = tempfile.mkdtemp(prefix='startup-bench-')
+    try:
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--child', name],
+            cwd=workdir)
+    finally:
+        shutil.rmtree(workdir)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0
+
+
+def print_results(results):
+    fmt = '{:<12}{:>12}{:>10}{:>10}{:>12}  {}'
+    print(fmt.format('Plugin', 'Import ms', 'Modules', 'Load ms', 'Unload ms', ''))
+    for name, row in sorted(results.items(), key=lambda i: i[1]['import'], reverse=True):
+        print(fmt.format(
+            name,
+            '{:.1f}'.format(row['import'] * 1000),
+            row['modules'],
+            '{:.1f}'.format(row['load'] * 1000),
+            '{:.1f}'.format(row['unload'] * 1000),
+            row['error'] or ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('plugins', nargs='*', help='plugin modules to measure (default: all)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return
+
+    results = {}
+    for name in args.plugins or plugin_modules():
+        runs = [run_child(name) for _ in range(args.repeat)]
+        results[name] = {
+            'import': median([run['import'] for run in runs]),
+            'modules': median([run['modules'] for run in runs]),
+            'load': median([run['load'] for run in runs]),
+            'unload': median([run['unload'] for run in runs]),
+            'error': runs[-1]['error'],
+        }
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
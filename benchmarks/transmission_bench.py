@@ -0,0 +1,154 @@
+"""
+Decode benchmark for Transmission RPC responses.
+
+Times TransmissionJSONDecoder against the original decoder (every key of every
+object rewritten, a new tzinfo per timestamp) on a large torrent-get response,
+after checking both decode it to the same result. Pass --fixture to use a
+recorded response; otherwise a synthetic one shaped like a full torrent-get
+(files, fileStats, peers and trackerStats per torrent) is generated.
+
+    python benchmarks/transmission_bench.py --torrents 2000
+    python benchmarks/transmission_bench.py --fixture torrent-get.json --repeat 20
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from plugins import torrent
+
+
+class LegacyTransmissionJSONDecoder(json.JSONDecoder):
+    def __init__(self, **kwargs):
+        return super(LegacyTransmissionJSONDecoder, self).__init__(
+            object_hook=self.object_hook, **kwargs)
+
+    def object_hook(self, obj):
+        for key, value in obj.items():
+            if key in torrent.TIMESTAMP_KEYS:
+                value = torrent.datetime.datetime.fromtimestamp(value, torrent.UTC())
+            obj[key] = value
+        return obj
+
+
+def make_fixture(torrents, files, peers, trackers):
+    now = int(time.time())
+    announce_times = [now - random.randint(0, 3600) for _ in range(20)]
+
+    def tracker(idx):
+        return {
+            'id': idx,
+            'tier': idx,
+            'announce': 'https://tracker{}.example/announce'.format(idx),
+            'host': 'https://tracker{}.example:443'.format(idx),
+            'seederCount': random.randint(0, 5000),
+            'leecherCount': random.randint(0, 500),
+            'lastAnnounceTime': random.choice(announce_times),
+            'lastAnnounceStartTime': random.choice(announce_times),
+            'lastScrapeTime': random.choice(announce_times),
+            'lastScrapeStartTime': random.choice(announce_times),
+            'nextAnnounceTime': random.choice(announce_times) + 3600,
+            'nextScrapeTime': 0,
+        }
+
+    def peer():
+        return {
+            'address': '10.0.{}.{}'.format(random.randint(0, 255), random.randint(0, 255)),
+            'clientName': 'Transmission 2.92',
+            'flagStr': 'TDEI',
+            'port': random.randint(1024, 65535),
+            'progress': random.random(),
+            'rateToClient': random.randint(0, 10 ** 6),
+            'rateToPeer': random.randint(0, 10 ** 5),
+        }
+
+    def item(idx):
+        size = random.randint(10 ** 6, 10 ** 10)
+        done = random.random() > 0.3
+        return {
+            'id': idx,
+            'name': 'Torrent {}'.format(idx),
+            'hashString': '{:040x}'.format(random.getrandbits(160)),
+            'status': random.choice((0, 4, 6)),
+            'totalSize': size,
+            'percentDone': 1.0 if done else random.random(),
+            'rateDownload': random.randint(0, 10 ** 7),
+            'rateUpload': random.randint(0, 10 ** 6),
+            'eta': -1 if done else random.randint(0, 86400),
+            'activityDate': now - random.randint(0, 86400),
+            'addedDate': now - random.randint(0, 10 ** 7),
+            'dateCreated': now - random.randint(0, 10 ** 8),
+            'doneDate': now - random.randint(0, 10 ** 6) if done else 0,
+            'startDate': now - random.randint(0, 10 ** 6),
+            'files': [
+                {'name': 'Torrent {}/file{}'.format(idx, f), 'length': size // files, 'bytesCompleted': 0}
+                for f in range(files)],
+            'fileStats': [
+                {'bytesCompleted': 0, 'priority': 0, 'wanted': True} for _ in range(files)],
+            'peers': [peer() for _ in range(random.randint(0, peers))],
+            'trackerStats': [tracker(t) for t in range(trackers)],
+        }
+
+    return json.dumps({
+        'result': 'success',
+        'tag': 0,
+        'arguments': {'torrents': [item(idx) for idx in range(torrents)]},
+    })
+
+
+def best_of(raw, cls, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        json.loads(raw, cls=cls)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--fixture', help='recorded torrent-get response to decode')
+    parser.add_argument('--torrents', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--peers', type=int, default=20)
+    parser.add_argument('--trackers', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    if args.fixture:
+        with open(args.fixture) as f:
+            raw = f.read()
+    else:
+        random.seed(args.seed)
+        raw = make_fixture(args.torrents, args.files, args.peers, args.trackers)
+
+    if json.loads(raw, cls=LegacyTransmissionJSONDecoder) != json.loads(raw, cls=torrent.TransmissionJSONDecoder):
+        print('Decoders disagree on this response!')
+        sys.exit(1)
+
+    results = {
+        'bytes': len(raw),
+        'legacy_seconds': best_of(raw, LegacyTransmissionJSONDecoder, args.repeat),
+        'current_seconds': best_of(raw, torrent.TransmissionJSONDecoder, args.repeat),
+        'plain_seconds': best_of(raw, json.JSONDecoder, args.repeat),
+    }
+
+    print('Response: {:.1f} MiB'.format(results['bytes'] / 1024.0 / 1024.0))
+    for name in ('legacy', 'current', 'plain'):
+        print('{:<10}{:>10.1f}ms'.format(name, results[name + '_seconds'] * 1000))
+    print('Speedup: {:.2f}x (plain json.loads is the floor)'.format(
+        results['legacy_seconds'] / results['current_seconds']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,30 @@
 import os
 import re
+import json
+import time
 import base64
+import gevent
+import hashlib
+import contextlib
+import tarfile
+import datetime
 import requests
 
-from peewee import SqliteDatabase, Model, TextField, BigIntegerField, IntegerField
-from holster.enum import Enum
 from StringIO import StringIO
-from PIL import Image
+from collections import defaultdict, namedtuple
 from gevent.lock import Semaphore
+from gevent.pool import Pool
+from gevent.threadpool import ThreadPool
+from peewee import fn
 
 from disco.bot import Plugin, Config, CommandLevels
+from disco.api.http import APIException
 from disco.gateway.events import MessageReactionAdd
+from disco.types.message import MessageTable
+from disco.util.logging import LoggingClass
 
-
-db = SqliteDatabase('emojis.db')
-
-# TODO
-#  - Make sure the state transitions are more concrete
-#  - Add prune command (deletes stale/bad emojis)
-#  - Add reload command or smth that reloads all reactions
-
-
-class Submission(Model):
-    State = Enum(
-        'COUNCIL_QUEUE',
-        'APPROVAL_QUEUE',
-        'DENIED',
-        'APPROVED',
-    )
-
-    class Meta:
-        database = db
-
-    name = TextField()
-    author = BigIntegerField()
-    contents = TextField(null=True)
-
-    temp_emoji_id = BigIntegerField(null=True)
-    submission_queue_msg = BigIntegerField(null=True)
-    council_queue_msg = BigIntegerField(null=True)
-    approval_queue_msg = BigIntegerField(null=True)
-
-    yay = IntegerField(default=0)
-    nay = IntegerField(default=0)
-
-    state = IntegerField(default=State.COUNCIL_QUEUE)
+from plugins.metrics import Histogram, fmt_duration
+from plugins.submissions import db, init_db, Aggregate, Submission, QUEUE_TIME_BUCKETS
 
 
 EMOJI_NAME_RE = re.compile(r':([a-zA-Z0-9_]+):')
@@ -55,6 +35,11 @@ BAD_SUGGESTION_MSG = 'Heya! Looks like you tried to suggest\
  like so: `:my_emoji_name:` and upload the emoji as an attachment. Feel\
  free to try again, and if you are still having problems ping a moderator!'
 
+DUPLICATE_SUGGESTION_MSG = 'Heya! Looks like the emoji you suggested\
+ to the Google Blob Server is identical to one that has already\
+ been submitted (`#{}`), so it won\'t be added to the vote queue. If you\
+ think this is a mistake, ping a moderator!'
+
 SUGGESTION_RECIEVED = 'Thanks for your emoji submission to the\
  Google Blob Server! It\'s been added to our internal vote queue,\
  so expect an update soon!'
@@ -67,7 +52,444 @@ GREEN_TICK_EMOJI = 'green_tick:305231298799206401'
 RED_TICK_EMOJI = 'red_tick:305231335512080385'
 
 
+def should_approve(yay, nay):
+    return yay >= 10 and yay - nay >= 5 and yay + nay >= 15
+
+
+def should_deny(yay, nay):
+    return nay >= 10 and nay - yay >= 5 and yay + nay >= 15
+
+
+class KeyedLocks(object):
+    """
+    A lock per key, created on first use and dropped again as soon as nobody
+    holds or waits on it, so locking on an unbounded set of keys (users,
+    submissions) doesn't keep a lock around for every key ever seen.
+    """
+    def __init__(self):
+        # Key -> [lock, greenlets holding or waiting on it]
+        self.locks = {}
+
+    def __len__(self):
+        return len(self.locks)
+
+    def __contains__(self, key):
+        return key in self.locks
+
+    @contextlib.contextmanager
+    def __call__(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [Semaphore(), 0]
+
+        entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+
+@contextlib.contextmanager
+def no_lock():
+    yield
+
+
+# States of the submissions kept in the duplicate index
+INDEXED_STATES = (
+    Submission.State.COUNCIL_QUEUE,
+    Submission.State.APPROVAL_QUEUE,
+    Submission.State.APPROVED,
+)
+
+
+class VoteTally(object):
+    """
+    In-memory yay/nay counts for the submissions sitting in the council queue.
+
+    Each submission gets its own lock, so reactions on different submissions
+    never wait on each other. Changed counts (and the per-voter aggregates)
+    are written back to the database in batches by `flush`.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.locks = KeyedLocks()
+        self.dirty = set()
+        self.voters = defaultdict(int)
+        self.flush_lock = Semaphore()
+
+    def __contains__(self, sid):
+        return sid in self.counts
+
+    def lock(self, sid):
+        """
+        Returns a context holding the submission's lock. Submissions that are
+        neither tracked nor locked by anyone (e.g. a late reaction after the
+        submission left the queue) don't get one, callers find them untracked
+        right away. A submission popped by a lock holder keeps its lock until
+        the holder and anyone waiting on it are done.
+        """
+        if sid not in self.counts and sid not in self.locks:
+            return no_lock()
+        return self.locks(sid)
+
+    def track(self, sid, yay=0, nay=0, dirty=False):
+        self.counts[sid] = [yay, nay]
+        if dirty:
+            self.dirty.add(sid)
+
+    def add(self, sid, yay=0, nay=0, voter=None):
+        counts = self.counts[sid]
+        counts[0] += yay
+        counts[1] += nay
+        self.dirty.add(sid)
+        if voter:
+            self.voters[voter] += yay + nay
+        return tuple(counts)
+
+    def pop(self, sid):
+        """
+        Stops tracking a submission, returning its final (yay, nay) counts (or
+        None if it was not being tracked). The caller is responsible for
+        persisting them.
+        """
+        self.dirty.discard(sid)
+        counts = self.counts.pop(sid, None)
+        return tuple(counts) if counts else None
+
+    def pending(self):
+        return {sid: tuple(self.counts[sid]) for sid in self.dirty if sid in self.counts}
+
+    def flush(self):
+        """
+        Writes all changed counts to the database in a single transaction. On
+        failure the counts stay dirty so the next flush retries them.
+        """
+        with self.flush_lock:
+            if not self.dirty and not self.voters:
+                return 0
+
+            dirty, self.dirty = self.dirty, set()
+            voters, self.voters = self.voters, defaultdict(int)
+            try:
+                with db.atomic():
+                    for voter, delta in voters.items():
+                        Aggregate.bump(Aggregate.Kind.VOTER, voter, delta)
+
+                    for sid in dirty:
+                        if sid not in self.counts:
+                            continue
+
+                        yay, nay = self.counts[sid]
+                        Submission.update(yay=yay, nay=nay).where(
+                            (Submission.id == sid) &
+                            (Submission.state == Submission.State.COUNCIL_QUEUE)
+                        ).execute()
+            except Exception:
+                self.dirty |= dirty
+                for voter, delta in voters.items():
+                    self.voters[voter] += delta
+                raise
+
+            return len(dirty)
+
+
+class SubmissionImageError(Exception):
+    pass
+
+
+RenderedEmoji = namedtuple('RenderedEmoji', ('png', 'digest', 'phash'))
+
+
+def dhash(Image, img, size=8):
+    """
+    Computes the 64-bit difference hash of an RGBA image, which stays stable
+    across rescaling and recompression of the same picture.
+    """
+    background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+    img = Image.alpha_composite(background, img).convert('L')
+    pixels = list(img.resize((size + 1, size), Image.ANTIALIAS).getdata())
+
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def fingerprint_emoji(Image, raw):
+    """
+    Returns the (digest, phash) of an already stored PNG.
+    """
+    img = Image.open(StringIO(raw)).convert('RGBA')
+    return hashlib.sha1(raw).hexdigest(), dhash(Image, img)
+
+
+def render_emoji(Image, raw, max_dimension, max_pixels):
+    """
+    Decodes an uploaded image, normalizes it and encodes it as a PNG. This is
+    CPU bound and runs on the pipeline's worker threads, never on the hub.
+    These take PIL's Image module from the pipeline rather than importing it,
+    see SubmissionPipeline.image.
+    """
+    try:
+        img = Image.open(StringIO(raw))
+    except IOError:
+        raise SubmissionImageError('Attachment is not a valid image')
+
+    # Check the header dimensions before decoding anything
+    if img.size[0] * img.size[1] > max_pixels:
+        raise SubmissionImageError('Image is too large ({}x{})'.format(*img.size))
+
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+
+    if img.size[0] > max_dimension or img.size[1] > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), Image.ANTIALIAS)
+
+    buff = StringIO()
+    img.save(buff, 'PNG', optimize=True)
+    png = buff.getvalue()
+    return RenderedEmoji(png, hashlib.sha1(png).hexdigest(), dhash(Image, img))
+
+
+class BKTree(object):
+    """
+    A BK-tree over 64-bit perceptual hashes using hamming distance, giving
+    sublinear lookups of every hash within a given distance of another.
+    Each node holds the set of values sharing its exact hash.
+    """
+    def __init__(self):
+        self.root = None
+
+    @staticmethod
+    def distance(a, b):
+        return bin(a ^ b).count('1')
+
+    def add(self, key, value):
+        if self.root is None:
+            self.root = (key, set([value]), {})
+            return
+
+        node = self.root
+        while True:
+            dist = self.distance(key, node[0])
+            if dist == 0:
+                node[1].add(value)
+                return
+
+            child = node[2].get(dist)
+            if child is None:
+                node[2][dist] = (key, set([value]), {})
+                return
+            node = child
+
+    def discard(self, key, value):
+        node = self.root
+        while node is not None:
+            dist = self.distance(key, node[0])
+            if dist == 0:
+                node[1].discard(value)
+                return
+            node = node[2].get(dist)
+
+    def search(self, key, radius):
+        """
+        Yields (distance, value) for every value within radius of key.
+        """
+        if self.root is None:
+            return
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            dist = self.distance(key, node[0])
+            if dist <= radius:
+                for value in node[1]:
+                    yield dist, value
+
+            for child_dist, child in node[2].items():
+                if dist - radius <= child_dist <= dist + radius:
+                    stack.append(child)
+
+
+class EmojiIndex(object):
+    """
+    Perceptual hash index of every approved or queued submission.
+    """
+    def __init__(self):
+        self.tree = BKTree()
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, sid, phash):
+        self.hashes[sid] = phash
+        self.tree.add(phash, sid)
+
+    def remove(self, sid):
+        phash = self.hashes.pop(sid, None)
+        if phash is not None:
+            self.tree.discard(phash, sid)
+
+    def nearest(self, phash, radius):
+        """
+        Returns the (distance, sid) of the closest indexed submission within
+        radius, or None.
+        """
+        matches = list(self.tree.search(phash, radius))
+        return min(matches) if matches else None
+
+
+class EmojiStore(object):
+    """
+    Content addressed storage for submission images, keyed by the SHA1 of
+    the PNG, so resubmissions of the same image share a single file.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, 'store', digest[:2], digest + '.png')
+
+    def legacy_path(self, sid):
+        return os.path.join(self.root, '{}.png'.format(sid))
+
+    def path_for(self, sub):
+        if sub.image_hash:
+            return self.path(sub.image_hash)
+        return self.legacy_path(sub.id)
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            pass
+
+    def put(self, digest, data):
+        path = self.path(digest)
+        if os.path.exists(path):
+            return path
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        # Write then rename, so a crash never leaves a partial object behind
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        return path
+
+
+class SubmissionPipeline(object):
+    """
+    Turns a submission attachment URL into a single normalized PNG buffer,
+    recording the latency of each stage.
+    """
+    def __init__(self, workers, max_bytes, max_dimension, max_pixels, timeout, latency=None):
+        self.pool = ThreadPool(workers)
+        self.max_bytes = max_bytes
+        self.max_dimension = max_dimension
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+        self.latency = latency if latency is not None else defaultdict(Histogram)
+        self._image = None
+
+    def close(self):
+        self.pool.kill()
+
+    @property
+    def image(self):
+        """
+        PIL's Image module, imported on first use. Always read on the hub: a
+        first import on a worker thread can deadlock on Python 2's import lock
+        with the hub. Its format plugins are loaded here too, as Image.open
+        would otherwise import them lazily on the worker.
+        """
+        if self._image is None:
+            from PIL import Image
+            Image.init()
+            self._image = Image
+        return self._image
+
+    def timed(self, stage):
+        return self.latency[stage].time()
+
+    def fetch(self, url):
+        """
+        Streams the attachment down, bailing out as soon as it goes over the
+        byte cap.
+        """
+        r = requests.get(url, stream=True, timeout=self.timeout)
+        try:
+            r.raise_for_status()
+
+            if int(r.headers.get('Content-Length') or 0) > self.max_bytes:
+                raise SubmissionImageError('Attachment is too large')
+
+            size = 0
+            buff = StringIO()
+            for chunk in r.iter_content(chunk_size=16 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise SubmissionImageError('Attachment is too large')
+                buff.write(chunk)
+            return buff.getvalue()
+        finally:
+            r.close()
+
+    def process(self, url):
+        with self.timed('download'):
+            raw = self.fetch(url)
+
+        with self.timed('render'):
+            return self.pool.apply(render_emoji, (self.image, raw, self.max_dimension, self.max_pixels))
+
+
+class RESTScheduler(LoggingClass):
+    """
+    Issues independent Discord REST calls concurrently.
+
+    Every call is tagged with a route key of (route name, major parameter),
+    matching how Discord buckets its rate limits. Calls sharing a key run one
+    at a time and in order, so a burst against one bucket queues up here
+    instead of racing into 429s, while calls against different buckets go
+    out in parallel. disco's own rate limiter still handles the waiting.
+    """
+    def __init__(self, size, latency=None):
+        super(RESTScheduler, self).__init__()
+        self.pool = Pool(size)
+        self.routes = KeyedLocks()
+        self.latency = latency if latency is not None else defaultdict(Histogram)
+
+    def close(self, timeout=5):
+        self.pool.join(timeout=timeout)
+        self.pool.kill()
+
+    def call(self, route, func, *args, **kwargs):
+        """
+        Schedules func, returning a greenlet whose `get` yields its result.
+        """
+        return self.pool.spawn(self._run, route, func, args, kwargs)
+
+    def _run(self, route, func, args, kwargs):
+        with self.routes(route):
+            try:
+                with self.latency[route[0]].time():
+                    return func(*args, **kwargs)
+            except Exception:
+                self.log.exception('REST call %s failed: ', route)
+                raise
+
+
 class BlobPluginConfig(Config):
+    database = 'emojis.db'
+
     # LIVE
     suggestion_channel = 295012914564169728
     council_queue_channel = 294924110130184193
@@ -75,6 +497,35 @@ class BlobPluginConfig(Config):
     approval_queue_channel = 289847856033169409
     emoji_role = 292388383823495168
 
+    # How often (in seconds) buffered council votes are written to the database
+    vote_flush_interval = 5
+
+    # Submission image processing
+    image_workers = 2
+    image_max_bytes = 8 * 1024 * 1024
+    image_max_pixels = 4096 * 4096
+    image_max_dimension = 128
+    image_download_timeout = (5, 30)
+
+    # Maximum dHash hamming distance (out of 64) at which a new submission is
+    #  flagged to the council as a possible duplicate of a queued or approved
+    #  one. Only byte for byte identical images are rejected outright.
+    duplicate_max_distance = 4
+
+    # Maximum number of concurrent Discord REST calls
+    rest_concurrency = 8
+
+    # Vote reconciliation: submissions per batch, concurrent submissions per
+    #  batch and seconds to pause between batches
+    reconcile_batch_size = 25
+    reconcile_concurrency = 4
+    reconcile_batch_delay = 1
+
+    # Prune/export: rows handled per batch, and where exports are written
+    prune_batch_size = 100
+    export_dir = 'exports'
+    export_max_upload = 8 * 1024 * 1024
+
     # TESTING
     # suggestion_channel = 305229423953838080
     # council_queue_channel = 305229442769223680
@@ -88,12 +539,158 @@ class BlobPlugin(Plugin):
     def load(self, ctx):
         super(BlobPlugin, self).load(ctx)
 
-        self.update_lock = Semaphore()
+        version, latest = init_db(self.config.database)
+        if version != latest:
+            self.log.info('Migrated submission database from version %s to %s', version, latest)
 
-        Submission.create_table(True)
         if not os.path.exists('emojis'):
             os.mkdir('emojis')
 
+        self.store = EmojiStore('emojis')
+        self.emoji_index = EmojiIndex()
+        for sub in Submission.select(Submission.id, Submission.phash).where(
+                (Submission.state << list(INDEXED_STATES)) & ~(Submission.phash >> None)):
+            self.emoji_index.add(sub.id, int(sub.phash, 16))
+
+        # Maps live council/approval queue message ids to their submission id,
+        #  so deletes of unrelated messages never have to touch the database.
+        self.queue_msgs = {}
+        self.votes = VoteTally()
+        for sub in Submission.select(
+                Submission.id, Submission.council_queue_msg, Submission.approval_queue_msg,
+                Submission.yay, Submission.nay, Submission.state).where(
+                (Submission.state == Submission.State.COUNCIL_QUEUE) |
+                (Submission.state == Submission.State.APPROVAL_QUEUE)):
+            self.track_queue_msg(sub.council_queue_msg, sub.id)
+            self.track_queue_msg(sub.approval_queue_msg, sub.id)
+            if sub.state == Submission.State.COUNCIL_QUEUE.index:
+                self.votes.track(sub.id, sub.yay, sub.nay)
+
+        # Votes that failed to flush before the last unload
+        for sid, (yay, nay) in (ctx.get('pending_votes') or {}).items():
+            if sid in self.votes:
+                self.votes.track(sid, yay, nay, dirty=True)
+
+        self.register_schedule(self.flush_votes, self.config.vote_flush_interval, init=False)
+
+        self.pipeline = SubmissionPipeline(
+            workers=self.config.image_workers,
+            max_bytes=self.config.image_max_bytes,
+            max_dimension=self.config.image_max_dimension,
+            max_pixels=self.config.image_max_pixels,
+            timeout=tuple(self.config.image_download_timeout),
+            latency=ctx.get('pipeline_latency'),
+        )
+
+        self.rest = RESTScheduler(self.config.rest_concurrency, latency=ctx.get('rest_latency'))
+
+        self.spawn(self.backfill_emoji_store)
+
+        self.reconciler = None
+        self.reconcile_cursor = ctx.get('reconcile_cursor', 0)
+
+        # On a fresh start this waits for Ready, on a reload we can go right away
+        if self.state.me:
+            self.start_reconcile()
+
+    def unload(self, ctx):
+        try:
+            self.votes.flush()
+        except Exception:
+            self.log.exception('Failed to flush votes on unload, carrying them over: ')
+            ctx['pending_votes'] = self.votes.pending()
+
+        self.pipeline.close()
+        ctx['pipeline_latency'] = self.pipeline.latency
+
+        self.rest.close()
+        ctx['rest_latency'] = self.rest.latency
+
+        if self.reconciler and not self.reconciler.dead:
+            ctx['reconcile_cursor'] = self.reconcile_cursor
+
+        # Stop anything still holding the connection before closing it
+        for greenlet in self.greenlets:
+            greenlet.kill()
+        db.close()
+        super(BlobPlugin, self).unload(ctx)
+
+    def flush_votes(self):
+        try:
+            count = self.votes.flush()
+        except Exception:
+            self.log.exception('Failed to flush votes, will retry: ')
+            return
+
+        if count:
+            self.log.debug('Flushed votes for %s submissions', count)
+
+    def backfill_emoji_store(self):
+        """
+        Moves submissions saved before the content addressed store existed into
+        it and indexes their perceptual hashes, a small batch at a time.
+        """
+        last_id = 0
+        while True:
+            batch = list(Submission.select(Submission.id, Submission.state).where(
+                (Submission.id > last_id) & (Submission.image_hash >> None)
+            ).order_by(Submission.id).limit(50))
+
+            if not batch:
+                break
+
+            for sub in batch:
+                last_id = sub.id
+                path = self.store.legacy_path(sub.id)
+                if not os.path.exists(path):
+                    continue
+
+                with open(path, 'rb') as f:
+                    raw = f.read()
+
+                try:
+                    digest, phash = self.pipeline.pool.apply(fingerprint_emoji, (self.pipeline.image, raw))
+                except Exception:
+                    self.log.exception('Failed to fingerprint %s, skipping: ', path)
+                    continue
+
+                self.store.put(digest, raw)
+                Submission.update(image_hash=digest, phash='{:016x}'.format(phash)).where(
+                    Submission.id == sub.id).execute()
+                os.remove(path)
+
+                if sub.state in [state.index for state in INDEXED_STATES]:
+                    self.emoji_index.add(sub.id, phash)
+
+            gevent.sleep(0)
+
+    def track_queue_msg(self, msg_id, sid):
+        if msg_id:
+            self.queue_msgs[msg_id] = sid
+
+    def untrack_queue_msg(self, msg_id):
+        if msg_id:
+            self.queue_msgs.pop(msg_id, None)
+
+    def send_dm(self, user, content):
+        return self.rest.call(('dm', user.id), lambda: user.open_dm().send_message(content))
+
+    def delete_message(self, channel, msg_id):
+        return self.rest.call(('messages_delete', channel.id), channel.delete_message, msg_id)
+
+    def send_vote_message(self, channel, content):
+        """
+        Posts a message and schedules the vote reactions on it (in order, so
+        they always show up green tick first).
+        """
+        msg = self.rest.call(('messages_create', channel.id), channel.send_message, content).get()
+
+        def add_reactions():
+            msg.add_reaction(GREEN_TICK_EMOJI)
+            msg.add_reaction(RED_TICK_EMOJI)
+        self.rest.call(('reactions', channel.id), add_reactions)
+        return msg
+
     @property
     def suggestion(self):
         return self.state.channels.get(self.config.suggestion_channel)
@@ -112,18 +709,24 @@ class BlobPlugin(Plugin):
 
     @Plugin.listen('MessageDelete')
     def on_message_delete(self, event):
+        sid = self.queue_msgs.get(event.id)
+        if sid is None:
+            return
+
         try:
             sub = Submission.select().where(
+                (Submission.id == sid) &
                 ((Submission.council_queue_msg == event.id) |
                 (Submission.approval_queue_msg == event.id)) &
                 (Submission.state != Submission.State.DENIED) &
                 (Submission.state != Submission.State.APPROVED)
             ).get()
         except Submission.DoesNotExist:
+            self.untrack_queue_msg(event.id)
             return
 
         self.log.info('Message was deleted for submission %s, marking submission as denied', sub.id)
-        self.council_deny(event, sub)
+        self.council_deny(sub)
 
     @Plugin.listen('MessageCreate')
     def on_message_create(self, event):
@@ -143,38 +746,53 @@ class BlobPlugin(Plugin):
 
         # Download, resize and post the emoji
         url = list(event.attachments.values())[0].url
-        r = requests.get(url)
 
         try:
-            r.raise_for_status()
-        except:
+            rendered = self.pipeline.process(url)
+        except Exception:
             event.delete()
             event.author.chain().open_dm().send_message(BAD_SUGGESTION_MSG)
-            self.log.exception('Failed to download uploaded attachment: ')
+            self.log.exception('Failed to process uploaded attachment: ')
             return
 
-        sub = Submission.create(
-            name=name,
-            author=event.author.id,
-        )
+        # Reject exact resubmissions of anything already queued or approved
+        identical = Submission.select(Submission.id).where(
+            (Submission.image_hash == rendered.digest) &
+            (Submission.state << list(INDEXED_STATES))).first()
+        if identical:
+            self.log.info('Rejecting submission %s, identical to #%s', name, identical.id)
+            event.delete()
+            event.author.chain().open_dm().send_message(DUPLICATE_SUGGESTION_MSG.format(identical.id))
+            return
+
+        # Near duplicates may well be deliberate variants, so the council decides
+        duplicate = self.emoji_index.nearest(rendered.phash, self.config.duplicate_max_distance)
+        if duplicate:
+            self.log.info('Flagging submission %s, distance %s from #%s', name, *duplicate)
 
         # Save the emoji on disk
-        img = Image.open(StringIO(r.content))
-        with open('emojis/{}.png'.format(sub.id), 'w') as f:
-            img.save(f)
+        with self.pipeline.timed('store'):
+            self.store.put(rendered.digest, rendered.png)
 
-        img_raw = StringIO()
-        img.save(img_raw, 'PNG')
-        img_raw.seek(0, 0)
+        sub = Submission.submit(
+            name=name,
+            author=event.author.id,
+            image_hash=rendered.digest,
+            phash='{:016x}'.format(rendered.phash),
+        )
+        self.emoji_index.add(sub.id, rendered.phash)
 
         try:
             # Upload the emoji temporarily
-            emoji = self.client.api.guilds_emojis_create(
-                event.guild.id,
-                name='{}_{}'.format(name, sub.id),
-                roles=[self.config.emoji_role],
-                image='data:image/png;base64,' + base64.b64encode(img_raw.getvalue()))
+            with self.pipeline.timed('upload'):
+                emoji = self.client.api.guilds_emojis_create(
+                    event.guild.id,
+                    name='{}_{}'.format(name, sub.id),
+                    roles=[self.config.emoji_role],
+                    image='data:image/png;base64,' + base64.b64encode(rendered.png))
         except Exception:
+            self.emoji_index.remove(sub.id)
+            sub.transition(Submission.State.FAILED)
             event.delete()
             event.author.chain().open_dm().send_message(BAD_SUGGESTION_MSG)
             return
@@ -187,32 +805,51 @@ class BlobPlugin(Plugin):
             sub.id,
         )
 
-        cmsg = self.council_queue.send_message(msg_contents)\
-            .chain(True)\
-            .add_reaction(GREEN_TICK_EMOJI)\
-            .add_reaction(RED_TICK_EMOJI)\
-            .first()
-
         # Repost submission to suggestions channel
-        msg_contents += ' [<{}>]'.format(url)
-        smsg = self.suggestion.send_message(msg_contents)
+        suggestion_contents = msg_contents + ' [<{}>]'.format(url)
+        smsg = self.rest.call(
+            ('messages_create', self.suggestion.id), self.suggestion.send_message, suggestion_contents)
 
         # Tell the user their submission was recieved
-        event.author.chain().open_dm().send_message(SUGGESTION_RECIEVED)
+        self.send_dm(event.author, SUGGESTION_RECIEVED)
+
+        # Only the council sees the possible duplicate
+        if duplicate:
+            msg_contents += u'\n:warning: possible duplicate of `#{1}` (distance {0})'.format(*duplicate)
 
-        # Delete the submission message
-        event.delete()
+        cmsg = self.send_vote_message(self.council_queue, msg_contents)
 
+        # Persist the vote message before waiting on anything else, so it is
+        #  never left behind without a submission pointing at it
         sub.council_queue_msg = cmsg.id
-        sub.submission_queue_msg = smsg.id
         sub.temp_emoji_id = emoji.id
-        sub.contents = msg_contents
-        sub.save()
+        sub.contents = suggestion_contents
+        sub.save(only=[
+            Submission.council_queue_msg,
+            Submission.temp_emoji_id,
+            Submission.contents,
+        ])
+        self.track_queue_msg(cmsg.id, sub.id)
+        self.votes.track(sub.id)
+
+        # The repost is only kept to clean it up later, the submission stands
+        #  without it (the scheduler already logged why it failed)
+        try:
+            smsg = smsg.get()
+        except Exception:
+            self.log.warning('Failed to repost submission %s to the suggestion channel', sub.id)
+        else:
+            # If the council already got to it, the cleanup missed the repost
+            if not Submission.update(submission_queue_msg=smsg.id).where(
+                    (Submission.id == sub.id) &
+                    (Submission.state == Submission.State.COUNCIL_QUEUE)).execute():
+                self.delete_message(self.suggestion, smsg.id)
+
+        # Delete the submission message, only once the submission is persisted
+        self.delete_message(event.channel, event.id)
 
     @Plugin.listen('MessageReactionAdd', 'MessageReactionRemove')
     def on_message_reaction_add(self, event):
-        update = None
-
         if event.user_id == self.client.state.me.id:
             return
 
@@ -222,89 +859,240 @@ class BlobPlugin(Plugin):
         unit = 1 if isinstance(event, MessageReactionAdd) else - 1
 
         if event.emoji.id == GREEN_TICK_ID:
-            update = {'yay': Submission.yay + unit}
+            update = {'yay': unit}
         elif event.emoji.id == RED_TICK_ID:
-            update = {'nay': Submission.nay + unit}
+            update = {'nay': unit}
         else:
             return
 
-        with self.update_lock:
-            Submission.update(**update).where(
-                (
-                    (Submission.state == Submission.State.COUNCIL_QUEUE) &
-                    (Submission.council_queue_msg == event.message_id)
-                )
-            ).execute()
+        sid = self.queue_msgs.get(event.message_id)
+        if sid is None:
+            return
+
+        with self.votes.lock(sid):
+            if sid not in self.votes:
+                return
+
+            yay, nay = self.votes.add(sid, voter=event.user_id, **update)
+            self.check_votes(sid, yay, nay)
+
+    def check_votes(self, sid, yay, nay):
+        """
+        Moves a council queue submission on if its votes pass either threshold.
+        Must be called holding the submission's vote lock.
+        """
+        self.log.info('checking submission (%s: %s yay %s nay)', sid, yay, nay)
+        if not should_approve(yay, nay) and not should_deny(yay, nay):
+            return
+
+        try:
+            sub = Submission.get(
+                (Submission.id == sid) &
+                (Submission.state == Submission.State.COUNCIL_QUEUE))
+        except Submission.DoesNotExist:
+            self.votes.pop(sid)
+            return
 
+        if should_approve(yay, nay):
+            self.council_approve(sub)
+        else:
+            self.council_deny(sub, True)
+
+    @Plugin.listen('Ready')
+    def on_ready(self, event):
+        # A new session means any reactions while we were disconnected were
+        #  never delivered to us.
+        self.start_reconcile()
+
+    def start_reconcile(self):
+        if self.reconciler and not self.reconciler.dead:
+            return False
+
+        self.reconciler = self.spawn(self.reconcile_votes)
+        return True
+
+    def reconcile_votes(self):
+        """
+        Recounts the vote reactions on every open council queue submission and
+        applies the voting thresholds, picking up any votes cast while we were
+        not listening. Submissions are fetched in bounded, concurrent batches
+        in id order, and the position is carried across reloads so an
+        interrupted pass resumes where it stopped.
+        """
+        pool = Pool(self.config.reconcile_concurrency)
+        updated = 0
+
+        while True:
+            batch = list(Submission.select(Submission.id, Submission.council_queue_msg).where(
+                (Submission.state == Submission.State.COUNCIL_QUEUE) &
+                (Submission.id > self.reconcile_cursor) &
+                ~(Submission.council_queue_msg >> None)
+            ).order_by(Submission.id).limit(self.config.reconcile_batch_size))
+
+            if not batch:
+                break
+
+            for sub, changed in zip(batch, pool.imap(self.reconcile_submission, batch)):
+                if changed:
+                    updated += 1
+                self.reconcile_cursor = sub.id
+
+            gevent.sleep(self.config.reconcile_batch_delay)
+
+        self.log.info('Reconciled votes up to submission %s, %s updated', self.reconcile_cursor, updated)
+        self.reconcile_cursor = 0
+
+    def reconcile_submission(self, sub):
+        """
+        Recounts a submission's votes, holding its vote lock from the fetch
+        until the counts are applied, so reactions handled in between can't
+        be overwritten by the (older) fetched counts. Returns whether anything
+        changed.
+        """
+        with self.votes.lock(sub.id):
+            if sub.id not in self.votes:
+                return False
+
+            counts = self.fetch_vote_counts(sub)
+            if counts is False:
+                return False
+            return self.apply_vote_counts(sub.id, counts)
+
+    def fetch_vote_counts(self, sub):
+        """
+        Returns the live (yay, nay) counts for a submission, None if its council
+        queue message is gone, or False if they could not be fetched.
+        """
+        try:
+            return tuple(
+                self.count_reactions(sub.council_queue_msg, emoji)
+                for emoji in (GREEN_TICK_EMOJI, RED_TICK_EMOJI))
+        except APIException as e:
+            if e.response.status_code == 404:
+                return None
+            self.log.exception('Failed to fetch votes for submission %s: ', sub.id)
+        except Exception:
+            self.log.exception('Failed to fetch votes for submission %s: ', sub.id)
+        return False
+
+    def count_reactions(self, msg_id, emoji):
+        count = 0
+        after = None
+
+        while True:
+            users = self.client.api.channels_messages_reactions_get(
+                self.config.council_queue_channel, msg_id, emoji, after=after, limit=100)
+            count += sum(1 for user in users if user.id != self.state.me.id)
+
+            if len(users) < 100:
+                return count
+            after = users[-1].id
+
+    def apply_vote_counts(self, sid, counts):
+        """
+        Must be called holding the submission's vote lock.
+        """
+        if sid not in self.votes:
+            return False
+
+        if counts is None:
             try:
-                sub = Submission.select().where(
-                    (
-                        (Submission.state == Submission.State.COUNCIL_QUEUE) &
-                        (Submission.council_queue_msg == event.message_id)
-                    )
-                ).get()
+                sub = Submission.get(id=sid)
             except Submission.DoesNotExist:
-                return
+                return False
+
+            self.log.info('Message was deleted for submission %s, marking submission as denied', sid)
+            self.council_deny(sub)
+            return True
 
-            self.log.info('checking submission (%s: %s yay %s nay)', sub.id, sub.yay, sub.nay)
-            if sub.yay >= 10 and sub.yay - sub.nay >= 5 and sub.yay + sub.nay >= 15:
-                self.council_approve(sub)
-            elif sub.nay >= 10 and sub.nay - sub.yay >= 5 and sub.yay + sub.nay >= 15:
-                self.council_deny(event, sub, True)
+        yay, nay = counts
+        if self.votes.counts[sid] == [yay, nay]:
+            return False
+
+        self.votes.track(sid, yay, nay, dirty=True)
+        self.check_votes(sid, yay, nay)
+        return True
 
     def council_approve(self, sub):
         self.log.info('Moving submission %s to approved', sub.id)
-        sub.state = Submission.State.APPROVAL_QUEUE
 
         # Post to approval queue
-        msg = self.approval_queue.send_message('<:{}:{}>'.format(sub.name, sub.temp_emoji_id))\
-            .chain(True)\
-            .add_reaction(GREEN_TICK_EMOJI)\
-            .add_reaction(RED_TICK_EMOJI)\
-            .first()
-        sub.approval_queue_msg = msg.id
-
-        # Post to changelog
-        self.council_changelog.send_message('<:{}> moved to <#{}>: <:{}:{}> (by <@{}>)'.format(
-            GREEN_TICK_EMOJI,
-            self.config.approval_queue_channel,
-            sub.name,
-            sub.temp_emoji_id,
-            sub.author,
-        ))
-
-        self.council_cleanup(sub)
-
-    def council_deny(self, event, sub, changelog=False):
-        self.log.info('Moving submission %s to denied', sub.id)
-        sub.state = Submission.State.DENIED
+        msg = self.send_vote_message(self.approval_queue, '<:{}:{}>'.format(sub.name, sub.temp_emoji_id))
+        if not self.council_cleanup(sub, Submission.State.APPROVAL_QUEUE, True, approval_queue_msg=msg.id):
+            self.delete_message(self.approval_queue, msg.id)
+            return False
+        self.track_queue_msg(msg.id, sub.id)
 
         # Post to changelog
-        if changelog:
-            self.council_changelog.send_message('<:{}> denied: <:{}:{}>'.format(
-                RED_TICK_EMOJI,
+        self.rest.call(
+            ('messages_create', self.council_changelog.id),
+            self.council_changelog.send_message,
+            '<:{}> moved to <#{}>: <:{}:{}> (by <@{}>)'.format(
+                GREEN_TICK_EMOJI,
+                self.config.approval_queue_channel,
                 sub.name,
                 sub.temp_emoji_id,
+                sub.author,
             ))
+        return True
 
-        event.guild.emojis.get(sub.temp_emoji_id).delete()
-        self.council_cleanup(sub)
+    def council_deny(self, sub, decided=False):
+        """
+        Denies a council queue submission. `decided` is set when the council
+        denied it (by vote or command), rather than its message going away.
+        """
+        self.log.info('Moving submission %s to denied', sub.id)
 
-    def council_cleanup(self, sub):
-        # Delete old messages
+        if not self.council_cleanup(sub, Submission.State.DENIED, decided):
+            return False
+
+        self.untrack_queue_msg(sub.approval_queue_msg)
+        self.emoji_index.remove(sub.id)
+
+        # Post to changelog
+        if decided:
+            self.rest.call(
+                ('messages_create', self.council_changelog.id),
+                self.council_changelog.send_message,
+                '<:{}> denied: <:{}:{}>'.format(
+                    RED_TICK_EMOJI,
+                    sub.name,
+                    sub.temp_emoji_id,
+                ))
+
+        guild_id = self.council_queue.guild_id
+        self.rest.call(('emojis', guild_id), self.client.api.guilds_emojis_delete, guild_id, sub.temp_emoji_id)
+        return True
+
+    def council_cleanup(self, sub, state, decided=False, **fields):
+        """
+        Moves a submission out of the council queue into the given state in one
+        commit, then deletes its queue messages. Returns False (doing nothing)
+        if the submission was already moved on by someone else.
+        """
         council_queue_msg = sub.council_queue_msg
         submission_queue_msg = sub.submission_queue_msg
-        sub.council_queue_msg = None
-        sub.submission_queue_msg = None
+
+        # Final vote counts are persisted with the transition
+        counts = self.votes.pop(sub.id)
+        if counts:
+            fields['yay'], fields['nay'] = counts
+
         self.log.info('Cleaning up submission %s; got to save', sub.id)
-        sub.save()
+        if not sub.transition(
+                state, council_decision=decided, council_queue_msg=None, submission_queue_msg=None, **fields):
+            self.log.warning('Submission %s was moved on concurrently, not cleaning up', sub.id)
+            return False
+        self.untrack_queue_msg(council_queue_msg)
 
         # Must happen after save
         if council_queue_msg:
-            self.council_queue.delete_message(council_queue_msg)
+            self.delete_message(self.council_queue, council_queue_msg)
 
         if submission_queue_msg:
-            self.suggestion.delete_message(submission_queue_msg)
+            self.delete_message(self.suggestion, submission_queue_msg)
+
+        return True
 
     @Plugin.command('info', '<sid:int>', group='blob', level=CommandLevels.TRUSTED)
     def on_blob_info(self, event, sid):
@@ -324,6 +1112,253 @@ class BlobPlugin(Plugin):
             sub.nay
         ))
 
+    def format_user(self, user_id):
+        user = self.state.users.get(user_id)
+        return unicode(user) if user else str(user_id)
+
+    @Plugin.command('stats', group='blob', level=CommandLevels.TRUSTED)
+    def on_blob_stats(self, event):
+        states = Aggregate.values(Aggregate.Kind.STATE)
+        lifetime = Aggregate.values(Aggregate.Kind.LIFETIME)
+        council = Aggregate.values(Aggregate.Kind.COUNCIL)
+
+        table = MessageTable()
+        table.set_header('State', 'Submissions', 'All Time')
+        for state in (Submission.State.COUNCIL_QUEUE, Submission.State.APPROVAL_QUEUE,
+                      Submission.State.DENIED, Submission.State.APPROVED, Submission.State.FAILED):
+            table.add(state.name.upper(), states.get(state.index, 0), lifetime.get(state.index, 0))
+        table.add('TOTAL', sum(states.values()), lifetime.get(Submission.State.COUNCIL_QUEUE.index, 0))
+
+        # Only what the council decided on, not deleted messages or failures
+        approved = council.get(Submission.State.APPROVAL_QUEUE.index, 0)
+        decided = approved + council.get(Submission.State.DENIED.index, 0)
+
+        lines = [table.compile()]
+        if decided:
+            lines.append('Council approval rate: `{:.1f}%` ({} of {})'.format(
+                100.0 * approved / decided, approved, decided))
+
+        # Median time in queue, to the resolution of the histogram buckets
+        queue_times = Aggregate.values(Aggregate.Kind.QUEUE_TIME)
+        total = sum(queue_times.values())
+        seen = 0
+        for bucket in sorted(queue_times):
+            seen += queue_times[bucket]
+            if seen * 2 >= total:
+                if bucket < len(QUEUE_TIME_BUCKETS):
+                    lines.append('Median time in council queue: `<= {}h`'.format(QUEUE_TIME_BUCKETS[bucket] / 3600))
+                else:
+                    lines.append('Median time in council queue: `> {}h`'.format(QUEUE_TIME_BUCKETS[-1] / 3600))
+                break
+
+        event.msg.reply('\n'.join(lines))
+
+    @Plugin.command('top', '[count:int]', group='blob', level=CommandLevels.TRUSTED)
+    def on_blob_top(self, event, count=10):
+        count = min(count, 25)
+
+        table = MessageTable()
+        table.set_header('#', 'Submitter', 'Submissions', 'Voter', 'Votes')
+
+        submitters = Aggregate.top(Aggregate.Kind.SUBMITTER, count)
+        voters = Aggregate.top(Aggregate.Kind.VOTER, count)
+        for idx in range(max(len(submitters), len(voters))):
+            row = [idx + 1]
+            for entries in (submitters, voters):
+                if idx < len(entries):
+                    row += [self.format_user(entries[idx][0]), entries[idx][1]]
+                else:
+                    row += ['', '']
+            table.add(*row)
+
+        event.msg.reply(table.compile())
+
+    @Plugin.command('pipeline', group='blob', level=CommandLevels.TRUSTED)
+    def on_blob_pipeline(self, event):
+        table = MessageTable()
+        table.set_header('Stage', 'Count', 'Mean', 'p50', 'p99', 'Max')
+
+        stages = [(stage, self.pipeline.latency[stage]) for stage in ('download', 'render', 'store', 'upload')]
+        stages += sorted(('rest:' + route, hist) for route, hist in self.rest.latency.items())
+
+        for stage, hist in stages:
+            table.add(
+                stage,
+                hist.count,
+                fmt_duration(hist.mean),
+                fmt_duration(hist.percentile(50)),
+                fmt_duration(hist.percentile(99)),
+                fmt_duration(hist.max))
+
+        event.msg.reply(table.compile())
+
+    def prune_submissions(self, cutoff, progress=None):
+        """
+        Deletes denied and failed submissions created before cutoff, along with
+        their images and any leftover temporary guild emojis. Only those, as
+        anything still queued may be in flight. Works through the table in id
+        order a bounded batch at a time, yielding between batches. Only the
+        current state counters are updated, the lifetime ones are left alone.
+
+        Submissions from before created_at was recorded have none. As ids only
+        go up, those are pruned only if they come before a submission that is
+        known to have been created before cutoff.
+        """
+        guild = self.council_queue.guild
+        last_id = 0
+        pruned = 0
+
+        cutoff_id = Submission.select(fn.MAX(Submission.id)).where(
+            Submission.created_at < cutoff).scalar() or 0
+
+        while True:
+            batch = list(Submission.select().where(
+                (Submission.id > last_id) &
+                (((Submission.created_at >> None) & (Submission.id <= cutoff_id)) |
+                    (Submission.created_at < cutoff)) &
+                (Submission.state << [Submission.State.DENIED, Submission.State.FAILED])
+            ).order_by(Submission.id).limit(self.config.prune_batch_size))
+
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            ids = [sub.id for sub in batch]
+            with db.atomic():
+                Submission.delete().where(Submission.id << ids).execute()
+                for sub in batch:
+                    Aggregate.bump(Aggregate.Kind.STATE, sub.state, -1)
+
+            for sub in batch:
+                self.emoji_index.remove(sub.id)
+                self.votes.pop(sub.id)
+
+                if not sub.image_hash:
+                    try:
+                        os.remove(self.store.legacy_path(sub.id))
+                    except OSError:
+                        pass
+                elif not Submission.select().where(Submission.image_hash == sub.image_hash).exists():
+                    self.store.remove(sub.image_hash)
+
+                if sub.temp_emoji_id and guild and sub.temp_emoji_id in guild.emojis:
+                    self.rest.call(
+                        ('emojis', guild.id), self.client.api.guilds_emojis_delete, guild.id, sub.temp_emoji_id)
+
+            pruned += len(batch)
+            if progress:
+                progress(pruned)
+            gevent.sleep(0)
+
+        return pruned
+
+    def export_approved(self, path):
+        """
+        Streams every approved emoji, plus a manifest.jsonl describing them, into
+        a gzipped tarball at path. Rows are read in bounded batches and files
+        are streamed straight into the archive, so memory use stays flat. A
+        partial tarball is removed if the export fails.
+        """
+        manifest_path = path + '.manifest'
+        try:
+            return self._export_approved(path, manifest_path)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+
+    def _export_approved(self, path, manifest_path):
+        last_id = 0
+        exported = 0
+
+        with open(manifest_path, 'w') as manifest, open(path, 'wb') as out:
+            tar = tarfile.open(fileobj=out, mode='w|gz')
+
+            while True:
+                batch = list(Submission.select().where(
+                    (Submission.id > last_id) &
+                    (Submission.state == Submission.State.APPROVED)
+                ).order_by(Submission.id).limit(self.config.prune_batch_size))
+
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                for sub in batch:
+                    image = self.store.path_for(sub)
+                    if not os.path.exists(image):
+                        continue
+
+                    filename = 'emojis/{}_{}.png'.format(sub.id, sub.name)
+                    tar.add(image, arcname=filename)
+                    manifest.write(json.dumps({
+                        'id': sub.id,
+                        'name': sub.name,
+                        'file': filename,
+                        'author': sub.author,
+                        'emoji_id': sub.temp_emoji_id,
+                        'sha1': sub.image_hash,
+                        'yay': sub.yay,
+                        'nay': sub.nay,
+                        'created_at': sub.created_at.isoformat() if sub.created_at else None,
+                    }) + '\n')
+                    exported += 1
+
+                gevent.sleep(0)
+
+            manifest.flush()
+            tar.add(manifest_path, arcname='manifest.jsonl')
+            tar.close()
+
+        return exported
+
+    @Plugin.command('prune', '[days:int]', group='blob', level=CommandLevels.OWNER)
+    def on_blob_prune(self, event, days=30):
+        msg = event.msg.reply('Pruning denied and failed submissions older than {} days...'.format(days))
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+        last_edit = [time.time()]
+
+        def progress(count):
+            if time.time() - last_edit[0] > 5:
+                last_edit[0] = time.time()
+                msg.edit('Pruning denied and failed submissions older than {} days... ({} so far)'.format(
+                    days, count))
+
+        pruned = self.prune_submissions(cutoff, progress)
+        msg.edit(':ok_hand: pruned {} submissions'.format(pruned))
+
+    @Plugin.command('export', group='blob', level=CommandLevels.OWNER)
+    def on_blob_export(self, event):
+        if not os.path.exists(self.config.export_dir):
+            os.mkdir(self.config.export_dir)
+
+        path = os.path.join(self.config.export_dir, 'blobs-{}.tar.gz'.format(int(time.time())))
+        msg = event.msg.reply('Exporting approved emojis...')
+        exported = self.export_approved(path)
+
+        # Too large to upload, so it's kept for someone to fetch from the host
+        if os.path.getsize(path) > self.config.export_max_upload:
+            return msg.edit(':ok_hand: exported {} emojis to `{}` (too large to upload)'.format(exported, path))
+
+        try:
+            with open(path, 'rb') as f:
+                event.msg.reply(
+                    ':ok_hand: exported {} emojis'.format(exported),
+                    attachment=(os.path.basename(path), f))
+        finally:
+            os.remove(path)
+        msg.delete()
+
+    @Plugin.command('reconcile', group='blob', level=CommandLevels.TRUSTED)
+    def on_blob_reconcile(self, event):
+        if not self.start_reconcile():
+            return event.msg.reply('Already reconciling votes (at submission #{})'.format(self.reconcile_cursor))
+        event.msg.reply(':ok_hand: reconciling votes for all open submissions')
+
     @Plugin.command('deny', '<sid:int>', group='blob', level=CommandLevels.TRUSTED)
     def on_blob_deny(self, event, sid):
         try:
@@ -332,18 +1367,22 @@ class BlobPlugin(Plugin):
             return event.msg.reply('Invalid submission ID')
 
         if sub.state == Submission.State.COUNCIL_QUEUE.index:
-            self.council_deny(event, sub, True)
+            self.council_deny(sub, True)
             return event.msg.reply(':ok_hand: denied')
 
         if sub.state != Submission.State.APPROVAL_QUEUE.index:
             return event.msg.reply('Not in approval queue')
 
-        self.approval_queue.delete_message(sub.approval_queue_msg)
-        sub.approval_queue_msg = None
-        event.guild.emojis.get(sub.temp_emoji_id).delete()
+        approval_queue_msg = sub.approval_queue_msg
+        if not sub.transition(Submission.State.DENIED, approval_queue_msg=None):
+            return event.msg.reply('Submission changed state, try again')
+        self.untrack_queue_msg(approval_queue_msg)
+        self.emoji_index.remove(sub.id)
+
+        self.delete_message(self.approval_queue, approval_queue_msg)
+        self.rest.call(
+            ('emojis', event.guild.id), self.client.api.guilds_emojis_delete, event.guild.id, sub.temp_emoji_id)
         event.msg.reply(':ok_hand: denied that emoji')
-        sub.state = Submission.State.DENIED
-        sub.save()
 
     @Plugin.command('approve', '<sid:int> [name:str]', group='blob', level=CommandLevels.TRUSTED)
     def on_blob_approve(self, event, sid, name=None):
@@ -362,9 +1401,18 @@ class BlobPlugin(Plugin):
         if not name:
             return event.msg.reply('no name provided, wolfiri plz')
 
-        self.approval_queue.delete_message(sub.approval_queue_msg)
-        sub.approval_queue_msg = None
-        event.guild.emojis.get(sub.temp_emoji_id).update(roles=[], name=name)
+        approval_queue_msg = sub.approval_queue_msg
+        if not sub.transition(Submission.State.APPROVED, approval_queue_msg=None):
+            return event.msg.reply('Submission changed state, try again')
+        self.untrack_queue_msg(approval_queue_msg)
+
+        self.delete_message(self.approval_queue, approval_queue_msg)
+        self.rest.call(
+            ('emojis', event.guild.id),
+            self.client.api.guilds_emojis_modify,
+            event.guild.id,
+            sub.temp_emoji_id,
+            roles=[],
+            name=name,
+        ).get()
         event.msg.reply(':ok_hand: approved that emoji')
-        sub.state = Submission.State.APPROVED
-        sub.save()
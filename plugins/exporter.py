@@ -0,0 +1,164 @@
+import time
+import gevent
+
+from collections import defaultdict
+from gevent.pywsgi import WSGIServer
+
+from disco.bot import Plugin, Config
+
+from plugins import instrument
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, escape_label(v)) for k, v in labels) + '}'
+
+
+class MetricsWriter(object):
+    """
+    Builds a response in the Prometheus text exposition format.
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lines = []
+
+    def metric(self, name, typ, doc):
+        name = '{}_{}'.format(self.namespace, name)
+        self.lines.append('# HELP {} {}'.format(name, doc))
+        self.lines.append('# TYPE {} {}'.format(name, typ))
+        return name
+
+    def sample(self, name, value, labels=()):
+        self.lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+    def gauge(self, name, doc, value):
+        self.sample(self.metric(name, 'gauge', doc), value)
+
+    def counters(self, name, doc, label, values):
+        name = self.metric(name, 'counter', doc)
+        for key, value in sorted(values.items()):
+            self.sample(name, value, ((label, key), ))
+
+    def histograms(self, name, doc, histograms):
+        """
+        Writes a histogram per set of labels, from (labels, Histogram) pairs.
+        """
+        name = self.metric(name, 'histogram', doc)
+        for labels, histogram in histograms:
+            seen = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                seen += count
+                self.sample(name + '_bucket', seen, labels + (('le', bound), ))
+            self.sample(name + '_bucket', histogram.count, labels + (('le', '+Inf'), ))
+            self.sample(name + '_sum', histogram.sum, labels)
+            self.sample(name + '_count', histogram.count, labels)
+
+    def render(self):
+        return ('\n'.join(self.lines) + '\n').encode('utf-8')
+
+
+class ExporterPluginConfig(Config):
+    # Where /metrics is served. When sharded, each shard listens on port plus
+    #  its shard id.
+    host = '127.0.0.1'
+    port = 9132
+
+    namespace = 'b1nb0t'
+
+    # Seconds a rendered response is reused for, so concurrent scrapers don't
+    #  each render it
+    cache_ttl = 1
+
+
+@Plugin.with_config(ExporterPluginConfig)
+class ExporterPlugin(Plugin):
+    def load(self, ctx):
+        super(ExporterPlugin, self).load(ctx)
+        instrument.install(self.bot)
+
+        self.rendered = None
+        self.rendered_at = 0
+
+        port = self.config.port + (self.bot.client.config.shard_id or 0)
+        self.server = WSGIServer((self.config.host, port), self.application, log=None)
+        self.server.start()
+        self.log.info('Serving metrics on %s:%s', self.config.host, port)
+
+    def unload(self, ctx):
+        self.server.stop(timeout=1)
+        super(ExporterPlugin, self).unload(ctx)
+
+    def application(self, environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+
+        if not self.rendered or time.time() - self.rendered_at > self.config.cache_ttl:
+            self.rendered = self.render()
+            self.rendered_at = time.time()
+
+        start_response('200 OK', [
+            ('Content-Type', CONTENT_TYPE),
+            ('Content-Length', str(len(self.rendered))),
+        ])
+        return [self.rendered]
+
+    def render(self):
+        writer = MetricsWriter(self.config.namespace)
+        state = self.bot.client.state
+
+        writer.gauge('guilds', 'Guilds in the state cache.', len(state.guilds))
+        writer.gauge('channels', 'Channels in the state cache.', len(state.channels))
+        writer.gauge('users', 'Users in the state cache.', len(state.users))
+        writer.gauge('greenlets', 'Active watchers on the gevent hub.', gevent.get_hub().loop.activecnt)
+
+        try:
+            import psutil
+            memory = psutil.Process().memory_info()
+
+            writer.gauge('memory_rss_bytes', 'Resident memory size.', memory.rss)
+            writer.gauge('memory_vms_bytes', 'Virtual memory size.', memory.vms)
+        except ImportError:
+            pass
+
+        util = self.bot.plugins.get('UtilPlugin')
+        if util:
+            writer.gauge('start_time_seconds', 'When the bot was started (unix time).', util.startup)
+            writer.counters('events_total', 'Gateway events received.', 'event', util.event_counter)
+
+        # Series of plugins that were reloaded are keyed by the old classes
+        handlers = defaultdict(instrument.HandlerStats)
+        for plugin, handler, event, value in instrument.rows():
+            handlers[(plugin, handler, event)].merge(value)
+        handlers = sorted(handlers.items())
+
+        writer.histograms(
+            'handler_duration_seconds',
+            'Time spent in plugin listeners and commands.',
+            [
+                ((('plugin', plugin), ('handler', handler), ('event', event)), value.latency)
+                for (plugin, handler, event), value in handlers
+            ])
+        writer.histograms(
+            'handler_delay_seconds',
+            'Time events waited between being received and a handler starting.',
+            [
+                ((('plugin', plugin), ('handler', handler), ('event', event)), value.delay)
+                for (plugin, handler, event), value in handlers if value.delay.count
+            ])
+
+        latency = self.bot.plugins.get('LatencyPlugin')
+        if latency:
+            writer.histograms(
+                'heartbeat_rtt_seconds',
+                'Gateway heartbeat round trip time.',
+                [((), latency.heartbeat_rtt)])
+
+        return writer.render()
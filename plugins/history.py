@@ -0,0 +1,180 @@
+import time
+import datetime
+
+from disco.bot import Plugin, Config, CommandLevels
+from disco.types.message import MessageTable
+
+from plugins.metrics import fmt_duration
+from plugins import timeseries
+
+
+def parse_period(text, now):
+    """
+    Parses `today`, `yesterday` (both UTC) or a duration back from now such as
+    `90m`, `24h` or `7d` into a (start, end) pair of timestamps.
+    """
+    text = (text or '24h').strip().lower()
+
+    midnight = (now // 86400) * 86400
+    if text == 'today':
+        return midnight, now
+    elif text == 'yesterday':
+        return midnight - 86400, midnight
+
+    units = {'m': 60, 'h': 3600, 'd': 86400}
+    if text[-1:] in units and text[:-1].isdigit():
+        return now - int(text[:-1]) * units[text[-1]], now
+
+    return None
+
+
+def fmt_period(start, end):
+    fmt = '%Y-%m-%d %H:%M'
+    return '{} - {} UTC'.format(
+        datetime.datetime.utcfromtimestamp(start).strftime(fmt),
+        datetime.datetime.utcfromtimestamp(end).strftime(fmt))
+
+
+class HistoryPluginConfig(Config):
+    database = 'history.db'
+
+    # How often (in seconds) new points are collected and written
+    flush_interval = 5
+
+    # How often (in seconds) complete minutes/hours are rolled up. Only done on
+    #  the first shard, as all of them share the database.
+    rollup_interval = 60
+
+    # How long raw points and minute rollups are kept (hour rollups are kept)
+    raw_retention = 2 * 24 * 3600
+    minute_retention = 30 * 24 * 3600
+
+
+@Plugin.with_config(HistoryPluginConfig)
+class HistoryPlugin(Plugin):
+    def load(self, ctx):
+        super(HistoryPlugin, self).load(ctx)
+        timeseries.init_db(self.config.database)
+
+        # Points not written yet, and the counter values already accounted for
+        self.buffer = ctx.get('history_buffer') or []
+        self.last_events = ctx.get('history_last_events') or {}
+        self.last_heartbeats = ctx.get('history_last_heartbeats')
+
+        self.register_schedule(self.flush, self.config.flush_interval, init=False)
+        if not self.bot.client.config.shard_id:
+            self.register_schedule(self.rollup, self.config.rollup_interval, init=False)
+
+    def unload(self, ctx):
+        self.flush()
+        ctx['history_buffer'] = self.buffer
+        ctx['history_last_events'] = self.last_events
+        ctx['history_last_heartbeats'] = self.last_heartbeats
+        timeseries.db.close()
+        super(HistoryPlugin, self).unload(ctx)
+
+    def collect(self):
+        now = time.time()
+
+        util = self.bot.plugins.get('UtilPlugin')
+        if util:
+            for name, count in list(util.event_counter.items()):
+                delta = count - self.last_events.get(name, 0)
+                # The counter went backwards, so it was reset
+                if delta < 0:
+                    delta = count
+                if delta:
+                    self.buffer.append(('event.' + name, now, delta))
+                self.last_events[name] = count
+
+        # New heartbeats are the tail of the deque, going by how many more the
+        #  histogram has seen since we last looked
+        latency = self.bot.plugins.get('LatencyPlugin')
+        if latency:
+            seen = latency.heartbeat_rtt.count
+            if self.last_heartbeats is not None and seen > self.last_heartbeats:
+                new = min(seen - self.last_heartbeats, len(latency.heartbeats))
+                for rtt in list(latency.heartbeats)[-new:]:
+                    self.buffer.append(('heartbeat', now, rtt / 1000.0))
+            self.last_heartbeats = seen
+
+    def flush(self):
+        self.collect()
+        if not self.buffer:
+            return
+
+        points, self.buffer = self.buffer, []
+        try:
+            timeseries.write_points(points)
+        except Exception:
+            self.log.exception('Failed to write %s points, will retry: ', len(points))
+            self.buffer = points + self.buffer
+
+    def rollup(self):
+        try:
+            timeseries.rollup(
+                self.config.flush_interval * 2,
+                self.config.raw_retention,
+                self.config.minute_retention)
+        except Exception:
+            self.log.exception('Failed to roll up points: ')
+
+    @Plugin.command('heartbeat', '[period:str]', group='history', level=CommandLevels.TRUSTED)
+    def history_heartbeat(self, event, period=None):
+        """
+        Shows heartbeat RTT percentiles over a period (e.g. `24h`, `yesterday`).
+        """
+        period = parse_period(period, time.time())
+        if not period:
+            event.msg.reply('Invalid period, try `90m`, `24h`, `7d`, `today` or `yesterday`')
+            return
+
+        _, total, _ = timeseries.query('heartbeat', *period)
+        if not total.count:
+            event.msg.reply('No heartbeats recorded over {}'.format(fmt_period(*period)))
+            return
+
+        table = MessageTable()
+        table.set_header('Heartbeats', 'Mean', 'p50', 'p95', 'p99', 'Max')
+        table.add(
+            total.count,
+            fmt_duration(total.mean),
+            fmt_duration(total.percentile(50)),
+            fmt_duration(total.percentile(95)),
+            fmt_duration(total.percentile(99)),
+            fmt_duration(total.max))
+        event.msg.reply('{}\n{}'.format(fmt_period(*period), table.compile()))
+
+    @Plugin.command('rate', '<name:str> [period:str]', group='history', level=CommandLevels.TRUSTED)
+    def history_rate(self, event, name, period=None):
+        """
+        Shows how often an event was received over a period (e.g. `MessageCreate
+        yesterday`).
+        """
+        period = parse_period(period, time.time())
+        if not period:
+            event.msg.reply('Invalid period, try `90m`, `24h`, `7d`, `today` or `yesterday`')
+            return
+
+        resolution, total, periods = timeseries.query('event.' + name, *period)
+        if not total.count:
+            event.msg.reply('No `{}` events recorded over {}'.format(name, fmt_period(*period)))
+            return
+
+        start, end = period
+        peak_ts, peak = max(periods, key=lambda i: i[1].sum)
+
+        table = MessageTable()
+        table.set_header('Event', 'Total', 'Avg/s', 'Peak/s', 'Peak At')
+        table.add(
+            name,
+            int(total.sum),
+            '{:.2f}'.format(total.sum / (end - start)),
+            '{:.2f}'.format(peak.sum / resolution),
+            datetime.datetime.utcfromtimestamp(peak_ts).strftime('%Y-%m-%d %H:%M'))
+        event.msg.reply('{}\n{}'.format(fmt_period(*period), table.compile()))
+
+    @Plugin.command('series', group='history', level=CommandLevels.TRUSTED)
+    def history_series(self, event):
+        names = timeseries.series_names()
+        event.msg.reply('`{}`'.format(', '.join(names) if names else 'No series recorded yet'))
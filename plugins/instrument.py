@@ -0,0 +1,110 @@
+import time
+import functools
+
+from collections import defaultdict
+
+from holster.emitter import Priority
+from disco.bot.plugin import Plugin
+
+from plugins.metrics import Histogram
+
+
+class HandlerStats(object):
+    """
+    How long handlers took to run (latency), and how long the events they
+    handled waited between being received from the gateway and the handler
+    starting (delay).
+    """
+    __slots__ = ('latency', 'delay')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.delay = Histogram()
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.delay.merge(other.delay)
+
+
+# Keyed by (plugin class, handler name, event class). Only the finest grain is
+#  recorded on the hot path, names are resolved and totals per handler or event
+#  type are summed when read.
+stats = defaultdict(HandlerStats)
+
+# The listener stamping events as they come off the gateway
+stamp_listener = None
+
+EVENT_NAMES = {
+    'dict': 'Packet',
+    'CommandEvent': 'Command',
+}
+
+NO_ATTRS = {}
+
+
+def stamp(event):
+    event.received_at = time.time()
+
+
+def timed_dispatch(self, typ, func, event, *args, **kwargs):
+    # Read as the handler starts, from the instance dict, as gateway events
+    #  proxy unknown attributes to the object they wrap. Every handler of an
+    #  event reads the same stamp, packets and commands have none.
+    received_at = getattr(event, '__dict__', NO_ATTRS).get('received_at')
+
+    start = time.time()
+    try:
+        return timed_dispatch.original(self, typ, func, event, *args, **kwargs)
+    finally:
+        value = stats[(self.__class__, (func.func if typ == 'command' else func).__name__, event.__class__)]
+        value.latency.observe(time.time() - start)
+        if received_at:
+            value.delay.observe(start - received_at)
+
+
+def rows():
+    """
+    Yields (plugin, handler, event type, stats) with everything keyed by name.
+    """
+    for (plugin, handler, event), value in list(stats.items()):
+        yield plugin.__name__, handler, EVENT_NAMES.get(event.__name__, event.__name__), value
+
+
+def summarize(by):
+    """
+    Returns the stats summed per handler ((plugin, handler) keys) or per event
+    type (event type keys). Also merges the stats of reloaded plugins.
+    """
+    totals = defaultdict(HandlerStats)
+    for plugin, handler, event, value in rows():
+        totals[(plugin, handler) if by == 'handler' else event].merge(value)
+    return totals
+
+
+def install(bot):
+    """
+    Times every listener and command of every plugin. All of them go through
+    Plugin.dispatch, which is swapped out for a timed version once per process
+    (so it survives plugin reloads). Listeners of plugins that were already
+    loaded hold on to the original, so they are re-pointed as well. Safe to
+    call more than once.
+    """
+    global stamp_listener
+
+    if Plugin.__dict__['dispatch'] is not timed_dispatch:
+        timed_dispatch.original = Plugin.__dict__['dispatch']
+        Plugin.dispatch = timed_dispatch
+
+    # BEFORE listeners run in the gateway greenlet as the event is emitted,
+    #  ahead of the greenlets spawned for the plugin listeners
+    if stamp_listener is None:
+        stamp_listener = bot.client.events.on('', stamp, priority=Priority.BEFORE)
+
+    for plugin in bot.plugins.values():
+        for listener in plugin.listeners:
+            callback = listener.callback
+            if not isinstance(callback, functools.partial):
+                continue
+
+            if getattr(callback.func, '__func__', None) is timed_dispatch.original:
+                listener.callback = functools.partial(plugin.dispatch, *callback.args)
@@ -11,6 +11,11 @@ from disco.bot import Plugin, CommandLevels
 from disco.gateway.packets import OPCode, RECV, SEND
 from disco.util.snowflake import to_unix_ms
 
+from plugins.metrics import Histogram
+
+# Heartbeat round trip buckets (in seconds)
+HEARTBEAT_BUCKETS = (.025, .05, .075, .1, .15, .2, .3, .5, 1, 2.5, 5)
+
 
 @contextlib.contextmanager
 def timed():
@@ -30,10 +35,12 @@ class LatencyPlugin(Plugin):
         super(LatencyPlugin, self).load(ctx)
         self.rtts = weakref.WeakValueDictionary()
         self.heartbeats = ctx.get('heartbeats') or deque(maxlen=100)
+        self.heartbeat_rtt = ctx.get('heartbeat_rtt') or Histogram(HEARTBEAT_BUCKETS)
         self.last_heartbeat = None
 
     def unload(self, ctx):
         ctx['heartbeats'] = self.heartbeats
+        ctx['heartbeat_rtt'] = self.heartbeat_rtt
         super(LatencyPlugin, self).unload(ctx)
 
     @Plugin.listen('MessageCreate')
@@ -44,7 +51,9 @@ class LatencyPlugin(Plugin):
     @Plugin.listen_packet((RECV, OPCode.HEARTBEAT_ACK))
     def on_heartbeat_ack(self, event):
         if self.last_heartbeat:
-            self.heartbeats.append(int((time.time() - self.last_heartbeat) * 1000))
+            rtt = time.time() - self.last_heartbeat
+            self.heartbeats.append(int(rtt * 1000))
+            self.heartbeat_rtt.observe(rtt)
 
     @Plugin.listen_packet((SEND, OPCode.HEARTBEAT))
     def on_heartbeat(self, event):
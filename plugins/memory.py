@@ -0,0 +1,153 @@
+import gc
+import os
+import sys
+import time
+
+import gevent
+
+from collections import defaultdict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Objects tallied between checks of the time slice
+WALK_CHUNK = 2000
+
+
+class HeapSnapshot(object):
+    """
+    Per-type object counts and (shallow) sizes of the heap at a point in time,
+    plus the bytes allocated per module when tracemalloc is tracing.
+    """
+    def __init__(self, types, modules=None, duration=0):
+        self.types = types
+        self.modules = modules
+        self.taken_at = time.time()
+        self.duration = duration
+
+    @property
+    def count(self):
+        return sum(count for count, _ in self.types.values())
+
+    @property
+    def size(self):
+        return sum(size for _, size in self.types.values())
+
+    def top(self, key, limit=15):
+        idx = 0 if key == 'count' else 1
+        return sorted(self.types.items(), key=lambda i: i[1][idx], reverse=True)[:limit]
+
+    def diff(self, older):
+        """
+        Returns (type, count delta, size delta) for every type that changed
+        since the older snapshot, largest growth first.
+        """
+        rows = []
+        for name in set(self.types) | set(older.types):
+            count, size = self.types.get(name, (0, 0))
+            old_count, old_size = older.types.get(name, (0, 0))
+            if count != old_count or size != old_size:
+                rows.append((name, count - old_count, size - old_size))
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def diff_modules(self, older):
+        """
+        Returns (module, size delta) of traced allocations, or None if either
+        snapshot was taken while tracemalloc wasn't tracing.
+        """
+        if self.modules is None or older.modules is None:
+            return None
+
+        rows = []
+        for name in set(self.modules) | set(older.modules):
+            delta = self.modules.get(name, 0) - older.modules.get(name, 0)
+            if delta:
+                rows.append((name, delta))
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+
+def walk_heap(slice_time=0.005):
+    """
+    Tallies every object tracked by the gc by type. Rather than sizing the
+    whole heap in one go (which can hold the hub for seconds on a large state
+    cache), this yields to the hub whenever it has run for `slice_time`.
+    """
+    start = time.time()
+    objects = gc.get_objects()
+    types = defaultdict(lambda: [0, 0])
+    getsizeof = sys.getsizeof
+
+    deadline = time.time() + slice_time
+    for idx in range(0, len(objects), WALK_CHUNK):
+        for obj in objects[idx:idx + WALK_CHUNK]:
+            entry = types[type(obj).__name__]
+            entry[0] += 1
+            entry[1] += getsizeof(obj)
+
+        if time.time() >= deadline:
+            gevent.sleep(0)
+            deadline = time.time() + slice_time
+
+    del objects
+    return HeapSnapshot(
+        {k: tuple(v) for k, v in types.items()},
+        modules=traced_modules(),
+        duration=time.time() - start)
+
+
+def tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def start_tracing(frames=1):
+    if tracemalloc is None:
+        return False
+    tracemalloc.start(frames)
+    return True
+
+
+def stop_tracing():
+    if tracing():
+        tracemalloc.stop()
+
+
+def module_files():
+    files = {}
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if path:
+            files[os.path.splitext(os.path.abspath(path))[0]] = name
+    return files
+
+
+def traced_modules():
+    """
+    Sums the live traced allocations by the module that made them, or returns
+    None if tracemalloc isn't available/tracing. Snapshotting and grouping
+    every trace takes as long as the heap is large, so like the heap walk it
+    stays off the hub, on the threadpool.
+    """
+    if not tracing():
+        return None
+
+    files = module_files()
+    stats = gevent.get_hub().threadpool.apply(take_statistics)
+
+    modules = defaultdict(int)
+    for filename, size in stats:
+        modules[files.get(os.path.splitext(os.path.abspath(filename))[0], filename)] += size
+    return dict(modules)
+
+
+def take_statistics():
+    """
+    Returns (filename, size) of the live traced allocations. Runs on a
+    threadpool worker.
+    """
+    return [
+        (stat.traceback[0].filename, stat.size)
+        for stat in tracemalloc.take_snapshot().statistics('filename')
+    ]
@@ -0,0 +1,224 @@
+import math
+import time
+import bisect
+import contextlib
+
+from array import array
+
+
+# Latency buckets (in seconds), roughly log spaced from 1ms to 10s
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """
+    A fixed-bucket histogram, cheap enough to update on every call of a hot
+    path. Percentiles are estimated as the upper bound of the bucket they
+    fall into.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for idx, count in enumerate(other.counts):
+            self.counts[idx] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+    @property
+    def mean(self):
+        return (self.sum / self.count) if self.count else 0.0
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+
+        target = self.count * pct / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[idx] if idx < len(self.buckets) else self.max
+        return self.max
+
+
+class RateCounter(object):
+    """
+    Counts events into a ring of per-second buckets (the last minute) and a
+    ring of per-minute buckets (the last quarter hour), so recent rates and
+    bursts can be read back instead of a lifetime average. Recording an event
+    is O(1) and allocates nothing; stale buckets are zeroed lazily as time
+    moves on.
+    """
+    __slots__ = ('seconds', 'minutes', 'now', 'total', 'peak')
+
+    # One more than the window, so a full window of complete buckets exists
+    #  alongside the current (partial) one
+    SECONDS = 61
+    MINUTES = 16
+
+    def __init__(self):
+        self.seconds = array('l', [0] * self.SECONDS)
+        self.minutes = array('l', [0] * self.MINUTES)
+        self.now = int(time.time())
+        self.total = 0
+        self.peak = 0
+
+    def advance(self, now):
+        if now <= self.now:
+            return
+
+        # Close out the seconds we've moved past, recording the peak
+        for second in range(self.now, min(now, self.now + self.SECONDS)):
+            if self.seconds[second % self.SECONDS] > self.peak:
+                self.peak = self.seconds[second % self.SECONDS]
+
+        for second in range(max(self.now + 1, now - self.SECONDS + 1), now + 1):
+            self.seconds[second % self.SECONDS] = 0
+
+        old_minute, minute = self.now // 60, now // 60
+        for idx in range(max(old_minute + 1, minute - self.MINUTES + 1), minute + 1):
+            self.minutes[idx % self.MINUTES] = 0
+
+        self.now = now
+
+    def hit(self, count=1):
+        now = int(time.time())
+        if now != self.now:
+            self.advance(now)
+
+        self.seconds[now % self.SECONDS] += count
+        self.minutes[(now // 60) % self.MINUTES] += count
+        self.total += count
+
+    def rate(self, seconds):
+        """
+        Average events per second over the last (complete) seconds, up to a
+        minute.
+        """
+        self.advance(int(time.time()))
+        return sum(
+            self.seconds[second % self.SECONDS]
+            for second in range(self.now - seconds, self.now)) / float(seconds)
+
+    def minute_rate(self, minutes):
+        """
+        Average events per second over the last (complete) minutes, up to a
+        quarter hour.
+        """
+        self.advance(int(time.time()))
+        minute = self.now // 60
+        return sum(
+            self.minutes[idx % self.MINUTES]
+            for idx in range(minute - minutes, minute)) / (minutes * 60.0)
+
+    def snapshot(self):
+        """
+        Returns (total, current/s, 1m/s, 5m/s, 15m/s, peak/s), where current
+        covers the last 10 seconds.
+        """
+        return (
+            self.total,
+            self.rate(10),
+            self.rate(60),
+            self.minute_rate(5),
+            self.minute_rate(15),
+            max(self.peak, self.seconds[self.now % self.SECONDS]),
+        )
+
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(value):
+    """
+    splitmix64 finalizer, spreads snowflakes (which share most of their high
+    bits) evenly over 64 bits.
+    """
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & MASK64
+    return value ^ (value >> 31)
+
+
+class HyperLogLog(object):
+    """
+    A HyperLogLog cardinality sketch over integer ids. With the default 2^12
+    registers it takes 4KiB regardless of how many ids are added, estimates
+    within ~1.6%, and sketches of different sets can be merged to estimate
+    the size of their union.
+    """
+    __slots__ = ('precision', 'registers')
+
+    # 2^-r for every possible register value
+    POWERS = tuple(2.0 ** -r for r in range(66))
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers or (1 << precision))
+
+    def add(self, value):
+        value = mix64(value)
+        width = 64 - self.precision
+        idx = value >> width
+        rank = width - (value & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def dumps(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def loads(cls, data, precision=12):
+        return cls(precision, bytearray(data))
+
+    def __len__(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(self.POWERS[r] for r in self.registers)
+
+        # Small range correction
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+def fmt_duration(seconds):
+    if seconds < 1:
+        return '{}ms'.format(int(seconds * 1000))
+    return '{:.2f}s'.format(seconds)
+
+
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
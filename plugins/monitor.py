@@ -0,0 +1,221 @@
+import sys
+import time
+import traceback
+
+import gevent
+import greenlet
+
+from collections import Counter, deque
+from gevent import monkey
+
+THREAD_MODULE = 'thread' if sys.version_info[0] == 2 else '_thread'
+
+# The monitors run on real OS threads, so they keep going while the hub is stuck
+start_new_thread = monkey.get_original(THREAD_MODULE, 'start_new_thread')
+get_ident = monkey.get_original(THREAD_MODULE, 'get_ident')
+sleep = monkey.get_original('time', 'sleep')
+
+
+# Our own tooling, which wraps (or watches) handlers rather than owning them
+TOOLING_MODULES = frozenset([__name__, 'plugins.instrument'])
+
+
+def frame_owner(frame):
+    """
+    Returns the (plugin, handler) a stack belongs to, that is the module and
+    function of the outermost frame from one of our plugins.
+    """
+    owner = (None, None)
+    while frame is not None:
+        module = frame.f_globals.get('__name__') or ''
+        if module.startswith('plugins.') and module not in TOOLING_MODULES:
+            owner = (module.split('.', 1)[1], frame.f_code.co_name)
+        frame = frame.f_back
+    return owner
+
+
+def frame_label(frame):
+    return '{}:{}'.format(frame.f_globals.get('__name__') or '?', frame.f_code.co_name)
+
+
+def is_idle(frame):
+    # With nothing to run the hub sits in its loop, the only frame on the stack
+    return frame.f_back is None and frame.f_code.co_name == 'run' and \
+        frame.f_globals.get('__name__') == 'gevent.hub'
+
+
+class BlockingEvent(object):
+    def __init__(self, started_at, duration, switches, glet, frame):
+        self.started_at = started_at
+        self.duration = duration
+        self.switches = switches
+        self.greenlet = repr(glet)
+        self.plugin, self.handler = frame_owner(frame)
+        self.stack = ''.join(traceback.format_stack(frame))
+
+
+class BlockingMonitor(object):
+    """
+    Flags greenlets that hold the hub for longer than `threshold` seconds.
+    Greenlet switches are tracked with a trace function, and a real thread
+    checks twice per threshold whether the same greenlet is still running, in
+    which case it captures that greenlet's stack.
+    """
+    def __init__(self, threshold=0.1, history=50):
+        self.threshold = threshold
+        self.history = deque(maxlen=history)
+        self.count = 0
+
+        self.hub = gevent.get_hub()
+        self.thread_ident = get_ident()
+        self.running = False
+        self.previous_trace = None
+
+        # Updated by the trace function on every switch
+        self.switches = 0
+        self.active = None
+        self.switched_at = time.time()
+
+        # The block currently in progress (if any)
+        self.current = None
+
+    def start(self):
+        self.running = True
+        self.previous_trace = greenlet.settrace(self.on_switch)
+        start_new_thread(self.run, ())
+
+    def stop(self):
+        self.running = False
+        greenlet.settrace(self.previous_trace)
+
+    def on_switch(self, event, args):
+        if event in ('switch', 'throw'):
+            self.switches += 1
+            self.active = args[1]
+            self.switched_at = time.time()
+
+        if self.previous_trace is not None:
+            self.previous_trace(event, args)
+
+    def run(self):
+        while self.running:
+            sleep(self.threshold / 2.0)
+            try:
+                self.check()
+            except Exception:
+                # Nothing on this thread can safely log (the logging locks are
+                #  gevent's), and the monitor must outlive odd frames.
+                pass
+
+    def check(self):
+        switches, active, since = self.switches, self.active, self.switched_at
+        blocked = time.time() - since
+
+        if active is None or active is self.hub or blocked < self.threshold:
+            return
+
+        # Still the same block, just keep its duration up to date
+        if self.current is not None and self.current.switches == switches:
+            self.current.duration = blocked
+            return
+
+        frame = sys._current_frames().get(self.thread_ident)
+        if frame is None:
+            return
+
+        event = BlockingEvent(since, blocked, switches, active, frame)
+
+        # The greenlet gave up the hub while we were looking, so this stack may
+        #  belong to something else
+        if self.switches != switches:
+            return
+
+        self.current = event
+        self.history.append(event)
+        self.count += 1
+
+    def recent(self):
+        return list(self.history)
+
+
+class Sampler(object):
+    """
+    A statistical profiler. A real thread samples the stack of whichever
+    greenlet holds the hub every `interval` seconds (suspended greenlets
+    aren't using any CPU), and tallies the samples by plugin handler, by
+    function and by full stack.
+    """
+    IDLE = '<idle>'
+    MAX_DEPTH = 64
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread_ident = get_ident()
+        self.running = False
+        self.finished = False
+
+        self.samples = 0
+        self.handlers = Counter()
+        self.functions = Counter()
+        self.stacks = Counter()
+
+    def start(self):
+        self.running = True
+        start_new_thread(self.run, ())
+
+    def stop(self):
+        """
+        Stops sampling, waiting (cooperatively) for the sampling thread to be
+        done with the counters.
+        """
+        self.running = False
+        while not self.finished:
+            gevent.sleep(self.interval)
+
+    def profile(self, seconds):
+        self.start()
+        try:
+            gevent.sleep(seconds)
+        finally:
+            self.stop()
+        return self
+
+    def run(self):
+        try:
+            while self.running:
+                sleep(self.interval)
+                try:
+                    self.sample()
+                except Exception:
+                    pass
+        finally:
+            self.finished = True
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_ident)
+        if frame is None:
+            return
+
+        self.samples += 1
+        if is_idle(frame):
+            self.handlers[self.IDLE] += 1
+            self.functions[self.IDLE] += 1
+            self.stacks[self.IDLE] += 1
+            return
+
+        plugin, handler = frame_owner(frame)
+        self.handlers['{}.{}'.format(plugin, handler) if plugin else 'other'] += 1
+        self.functions[frame_label(frame)] += 1
+
+        stack = []
+        while frame is not None and len(stack) < self.MAX_DEPTH:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """
+        Returns the samples in the collapsed stack format read by
+        flamegraph.pl/speedscope.
+        """
+        return '\n'.join('{} {}'.format(stack, count) for stack, count in self.stacks.most_common())
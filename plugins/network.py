@@ -1,8 +1,6 @@
 import socket
 import subprocess
 
-from ipwhois import IPWhois
-
 from disco.bot import Plugin, CommandLevels
 from disco.types.message import MessageEmbed
 
@@ -31,6 +29,8 @@ class NetworkPlugin(Plugin):
 
     @Plugin.command('ipinfo', '<host:str>', level=CommandLevels.TRUSTED)
     def whois(self, event, host):
+        from ipwhois import IPWhois
+
         host = socket.gethostbyname(host)
         data = IPWhois(address=host).lookup_rdap()
 
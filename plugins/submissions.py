@@ -0,0 +1,268 @@
+import bisect
+import datetime
+
+from peewee import (
+    SqliteDatabase, Model, TextField, BigIntegerField, IntegerField, DateTimeField, CompositeKey, fn
+)
+from playhouse.migrate import SqliteMigrator
+from holster.enum import Enum
+
+
+PRAGMAS = (
+    # WAL turns every commit into an append to the log instead of a rollback
+    #  journal rewrite, and lets reads carry on while a write is in flight.
+    ('journal_mode', 'wal'),
+    # In WAL mode NORMAL only syncs on checkpoints. A power loss can drop the
+    #  last few commits, but never corrupts the database.
+    ('synchronous', 'normal'),
+    ('cache_size', -8 * 1024),
+    ('temp_store', 'memory'),
+    ('busy_timeout', 5000),
+)
+
+# All greenlets share a single connection (rather than peewee opening one per
+#  greenlet). SQLite calls never yield to the hub, so statements can't
+#  interleave; just never yield inside a transaction.
+db = SqliteDatabase(None, pragmas=PRAGMAS, threadlocals=False)
+
+# Upper bounds (in seconds) of the time-in-council-queue histogram buckets
+QUEUE_TIME_BUCKETS = tuple(i * 3600 for i in (1, 2, 4, 8, 12, 24, 36, 48, 72, 96, 120, 168, 336, 720))
+
+
+class Aggregate(Model):
+    """
+    Counters kept up to date by the submission state transitions (in the
+    same commit), so statistics never need to scan the submission table.
+    """
+    Kind = Enum(
+        # Submissions currently in each state, keyed by state
+        'STATE',
+        # Submissions that ever entered each state, keyed by state. Unlike
+        #  STATE these are never decremented, pruning doesn't rewrite history.
+        'LIFETIME',
+        # Submissions per author, keyed by user id
+        'SUBMITTER',
+        # Net council votes per user, keyed by user id
+        'VOTER',
+        # Histogram of time spent in the council queue, keyed by bucket
+        'QUEUE_TIME',
+        # Submissions the council moved on (by vote or command), keyed by the
+        #  state they were moved to
+        'COUNCIL',
+    )
+
+    class Meta:
+        database = db
+        db_table = 'submission_aggregate'
+        primary_key = CompositeKey('kind', 'key')
+        indexes = (
+            (('kind', 'value'), False),
+        )
+
+    kind = IntegerField()
+    key = BigIntegerField()
+    value = IntegerField(default=0)
+
+    @classmethod
+    def bump(cls, kind, key, delta=1):
+        if not delta:
+            return
+
+        kind = int(kind)
+        cls.insert(kind=kind, key=key, value=0).on_conflict('IGNORE').execute()
+        cls.update(value=cls.value + delta).where((cls.kind == kind) & (cls.key == key)).execute()
+
+    @classmethod
+    def values(cls, kind):
+        return {row.key: row.value for row in cls.select().where(cls.kind == int(kind))}
+
+    @classmethod
+    def top(cls, kind, count=10):
+        return [
+            (row.key, row.value) for row in cls.select().where(
+                (cls.kind == int(kind)) & (cls.value > 0)
+            ).order_by(cls.value.desc()).limit(count)
+        ]
+
+
+def queue_time_bucket(seconds):
+    return bisect.bisect_left(QUEUE_TIME_BUCKETS, seconds)
+
+
+class Submission(Model):
+    State = Enum(
+        'COUNCIL_QUEUE',
+        'APPROVAL_QUEUE',
+        'DENIED',
+        'APPROVED',
+        # Never made it into the council queue (e.g. the emoji upload failed)
+        'FAILED',
+    )
+
+    class Meta:
+        database = db
+
+    name = TextField()
+    author = BigIntegerField(index=True)
+    contents = TextField(null=True)
+
+    temp_emoji_id = BigIntegerField(null=True)
+    submission_queue_msg = BigIntegerField(null=True)
+    council_queue_msg = BigIntegerField(null=True, index=True)
+    approval_queue_msg = BigIntegerField(null=True, index=True)
+
+    yay = IntegerField(default=0)
+    nay = IntegerField(default=0)
+
+    state = IntegerField(default=State.COUNCIL_QUEUE, index=True)
+
+    # SHA1 of the stored PNG, and its 64-bit dHash as hex
+    image_hash = TextField(null=True, index=True)
+    phash = TextField(null=True)
+
+    created_at = DateTimeField(null=True, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def submit(cls, **fields):
+        """
+        Creates a new submission in the council queue.
+        """
+        with db.atomic():
+            sub = cls.create(**fields)
+            Aggregate.bump(Aggregate.Kind.STATE, int(sub.state))
+            Aggregate.bump(Aggregate.Kind.LIFETIME, int(sub.state))
+            Aggregate.bump(Aggregate.Kind.SUBMITTER, sub.author)
+        return sub
+
+    def transition(self, state, council_decision=False, **fields):
+        """
+        Moves this submission into a new state, writing the state and any other
+        changed fields with a single UPDATE in a single commit. The update is
+        guarded on the state we loaded, so if the row was moved on by someone
+        else in the meantime nothing is written and False is returned. Moves
+        decided by the council are counted as such in the same commit.
+        """
+        fields['state'] = state
+        old, new = int(self.state), int(state)
+
+        with db.atomic():
+            updated = Submission.update(**fields).where(
+                (Submission.id == self.id) &
+                (Submission.state == old)
+            ).execute()
+
+            if updated and old != new:
+                Aggregate.bump(Aggregate.Kind.STATE, old, -1)
+                Aggregate.bump(Aggregate.Kind.STATE, new)
+                Aggregate.bump(Aggregate.Kind.LIFETIME, new)
+
+                # Failed submissions were never actually queued
+                if old == Submission.State.COUNCIL_QUEUE.index and self.created_at and \
+                        new != Submission.State.FAILED.index:
+                    queued = (datetime.datetime.utcnow() - self.created_at).total_seconds()
+                    Aggregate.bump(Aggregate.Kind.QUEUE_TIME, queue_time_bucket(queued))
+
+                if council_decision:
+                    Aggregate.bump(Aggregate.Kind.COUNCIL, new)
+
+        if not updated:
+            return False
+
+        for key, value in fields.items():
+            setattr(self, key, value)
+        return True
+
+
+def add_columns(migrator, model, *fields):
+    table = model._meta.db_table
+    columns = set(column.name for column in db.get_columns(table))
+    for field in fields:
+        if field.db_column not in columns:
+            migrator.add_column(table, field.db_column, field).run()
+
+
+def add_indexes(model, *fields):
+    for field in fields:
+        db.execute_sql('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'.format(
+            model._meta.db_table, field.db_column))
+
+
+# Schema migrations, applied in order and tracked in SQLite's user_version.
+#  Databases created from scratch already have the latest schema, so each
+#  migration must be safe to run against it.
+MIGRATIONS = (
+    lambda migrator: add_indexes(
+        Submission,
+        Submission.state,
+        Submission.council_queue_msg,
+        Submission.approval_queue_msg,
+        Submission.author),
+    lambda migrator: (
+        add_columns(migrator, Submission, Submission.image_hash, Submission.phash),
+        add_indexes(Submission, Submission.image_hash)),
+    lambda migrator: (
+        add_columns(migrator, Submission, Submission.created_at),
+        backfill_aggregates()),
+    lambda migrator: backfill_lifetime_aggregates(),
+)
+
+
+def backfill_aggregates():
+    """
+    Seeds the aggregate counters from the existing submissions, the one time
+    they are allowed to scan the table. Votes and queue times weren't tracked
+    before, so they start from zero.
+    """
+    Aggregate.delete().where(
+        Aggregate.kind << [int(Aggregate.Kind.STATE), int(Aggregate.Kind.SUBMITTER)]
+    ).execute()
+
+    for column, kind in ((Submission.state, Aggregate.Kind.STATE), (Submission.author, Aggregate.Kind.SUBMITTER)):
+        for key, count in Submission.select(column, fn.COUNT(Submission.id)).group_by(column).tuples():
+            Aggregate.bump(kind, key, count)
+
+
+def backfill_lifetime_aggregates():
+    """
+    Seeds the lifetime counters from the submissions that are left. Anything
+    pruned before they existed is gone for good.
+    """
+    states = dict(Submission.select(Submission.state, fn.COUNT(Submission.id)).group_by(
+        Submission.state).tuples())
+
+    # Every submission started in the council queue, and every approved one
+    #  passed through the approval queue
+    lifetime = dict(states)
+    lifetime[Submission.State.COUNCIL_QUEUE.index] = sum(states.values())
+    lifetime[Submission.State.APPROVAL_QUEUE.index] = sum(
+        states.get(state.index, 0) for state in (Submission.State.APPROVAL_QUEUE, Submission.State.APPROVED))
+
+    Aggregate.delete().where(Aggregate.kind == int(Aggregate.Kind.LIFETIME)).execute()
+    for state, count in lifetime.items():
+        Aggregate.bump(Aggregate.Kind.LIFETIME, state, count)
+
+
+def schema_version():
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def migrate():
+    migrator = SqliteMigrator(db)
+    version = schema_version()
+
+    for idx, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with db.atomic():
+            migration(migrator)
+            db.execute_sql('PRAGMA user_version = {}'.format(idx))
+
+    return version, len(MIGRATIONS)
+
+
+def init_db(path):
+    """
+    Opens (creating and migrating if required) the submission database.
+    """
+    db.init(path)
+    db.connect()
+    db.create_tables([Submission, Aggregate], safe=True)
+    return migrate()
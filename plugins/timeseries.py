@@ -0,0 +1,194 @@
+import time
+
+from collections import defaultdict
+
+from peewee import SqliteDatabase, Model, TextField, IntegerField, DoubleField, CompositeKey, fn
+
+from plugins.metrics import Histogram
+
+PRAGMAS = (
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('busy_timeout', 5000),
+)
+
+db = SqliteDatabase(None, pragmas=PRAGMAS, threadlocals=False)
+
+# Buckets values are summarized into when rolled up, log spaced with 25% steps
+#  from 1ms to ~1m (so percentiles read back from rollups are within 25%)
+BUCKETS = tuple(round(0.001 * 1.25 ** i, 6) for i in range(50))
+
+# Raw points written per INSERT, keeping under SQLite's bound variable limit
+INSERT_BATCH = 300
+
+
+class Point(Model):
+    """
+    A raw observation. Counters are written as the delta since the last
+    write, distributions (e.g. heartbeat RTT) as individual values.
+    """
+    class Meta:
+        database = db
+        indexes = (
+            (('ts', ), False),
+        )
+
+    series = TextField()
+    ts = DoubleField()
+    value = DoubleField()
+
+
+class Rollup(Model):
+    """
+    All of a series' points within one period, summarized as a histogram.
+    """
+    series = TextField()
+    ts = IntegerField()
+    count = IntegerField()
+    sum = DoubleField()
+    max = DoubleField()
+    buckets = TextField()
+
+    def histogram(self):
+        histogram = Histogram(BUCKETS)
+        histogram.counts = [int(i) for i in self.buckets.split(',')]
+        histogram.count = self.count
+        histogram.sum = self.sum
+        histogram.max = self.max
+        return histogram
+
+
+class MinuteRollup(Rollup):
+    resolution = 60
+
+    class Meta:
+        database = db
+        primary_key = CompositeKey('series', 'ts')
+        indexes = (
+            (('ts', ), False),
+        )
+
+
+class HourRollup(Rollup):
+    resolution = 3600
+
+    class Meta:
+        database = db
+        primary_key = CompositeKey('series', 'ts')
+        indexes = (
+            (('ts', ), False),
+        )
+
+
+def write_points(points):
+    """
+    Writes buffered (series, ts, value) points in a single commit.
+    """
+    with db.atomic():
+        for idx in range(0, len(points), INSERT_BATCH):
+            Point.insert_many([
+                {'series': series, 'ts': ts, 'value': value}
+                for series, ts, value in points[idx:idx + INSERT_BATCH]
+            ]).execute()
+
+
+def watermark(model):
+    """
+    Returns the start of the first period of the model which isn't rolled up.
+    """
+    last = model.select(fn.MAX(model.ts)).scalar()
+    if last is not None:
+        return last + model.resolution
+
+    source = Point if model is MinuteRollup else MinuteRollup
+    first = source.select(fn.MIN(source.ts)).scalar()
+    if first is None:
+        return None
+    return int(first // model.resolution) * model.resolution
+
+
+def save_rollups(model, rollups):
+    with db.atomic():
+        for (series, ts), histogram in rollups.items():
+            model.insert(
+                series=series,
+                ts=ts,
+                count=histogram.count,
+                sum=histogram.sum,
+                max=histogram.max,
+                buckets=','.join(str(i) for i in histogram.counts),
+            ).on_conflict('REPLACE').execute()
+
+
+def rollup_minutes(start, end):
+    rollups = defaultdict(lambda: Histogram(BUCKETS))
+    points = Point.select(Point.series, Point.ts, Point.value).where(
+        (Point.ts >= start) & (Point.ts < end)).tuples()
+
+    for series, ts, value in points:
+        rollups[(series, int(ts // 60) * 60)].observe(value)
+
+    save_rollups(MinuteRollup, rollups)
+    return len(rollups)
+
+
+def rollup_hours(start, end):
+    rollups = defaultdict(lambda: Histogram(BUCKETS))
+    for row in MinuteRollup.select().where((MinuteRollup.ts >= start) & (MinuteRollup.ts < end)):
+        rollups[(row.series, row.ts // 3600 * 3600)].merge(row.histogram())
+
+    save_rollups(HourRollup, rollups)
+    return len(rollups)
+
+
+def rollup(grace, raw_retention, minute_retention):
+    """
+    Rolls up every complete minute that ended over `grace` seconds ago (so
+    buffered points have been written), then every hour whose minutes are
+    all rolled up, and drops raw points/minutes past their retention.
+    """
+    now = time.time()
+
+    start = watermark(MinuteRollup)
+    end = int((now - grace) // 60) * 60
+    if start is not None and start < end:
+        rollup_minutes(start, end)
+
+    start = watermark(HourRollup)
+    minutes_end = watermark(MinuteRollup)
+    if start is not None and minutes_end is not None:
+        end = minutes_end // 3600 * 3600
+        if start < end:
+            rollup_hours(start, end)
+
+    Point.delete().where(Point.ts < now - raw_retention).execute()
+    MinuteRollup.delete().where(MinuteRollup.ts < now - minute_retention).execute()
+
+
+def query(series, start, end):
+    """
+    Summarizes a series between two times from the rollups (by the minute for
+    up to two days, by the hour past that). Returns the merged histogram and
+    a list of (ts, histogram) per period.
+    """
+    model = MinuteRollup if end - start <= 2 * 24 * 3600 else HourRollup
+    total = Histogram(BUCKETS)
+    periods = []
+
+    for row in model.select().where(
+            (model.series == series) & (model.ts >= start) & (model.ts < end)).order_by(model.ts):
+        histogram = row.histogram()
+        total.merge(histogram)
+        periods.append((row.ts, histogram))
+
+    return model.resolution, total, periods
+
+
+def series_names():
+    return [row.series for row in MinuteRollup.select(MinuteRollup.series).distinct().order_by(MinuteRollup.series)]
+
+
+def init_db(path):
+    db.init(path)
+    db.connect()
+    db.create_tables([Point, MinuteRollup, HourRollup], safe=True)
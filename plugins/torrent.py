@@ -1,3 +1,4 @@
+import time
 import urllib
 import requests
 import json
@@ -5,9 +6,16 @@ import calendar
 import datetime
 import base64
 
-from pyquery import PyQuery as PQ
+from collections import defaultdict, OrderedDict
+from gevent.event import Event
+from gevent.lock import Semaphore
+from requests.adapters import HTTPAdapter
 
+from disco.api.http import APIException
 from disco.bot import Plugin, Config, CommandLevels
+from disco.types.message import MessageTable
+
+from plugins.metrics import Histogram, fmt_duration, sizeof_fmt
 
 
 BASE_URL = 'https://iptorrents.eu'
@@ -18,6 +26,34 @@ CSRF_ERROR_CODE = 409
 UNAUTHORIZED_ERROR_CODE = 401
 CSRF_HEADER = 'X-Transmission-Session-Id'
 
+# Fields kept for every torrent in the status cache
+STATUS_FIELDS = (
+    'id', 'name', 'hashString', 'status', 'error', 'errorString', 'percentDone',
+    'rateDownload', 'rateUpload', 'eta', 'totalSize', 'addedDate', 'doneDate')
+
+TORRENT_STATUS = (
+    'stopped',
+    'check queued',
+    'checking',
+    'download queued',
+    'downloading',
+    'seed queued',
+    'seeding',
+)
+
+# Transmission considers a torrent recently active for a minute after its last
+#  change, so deltas are only complete if we synced within that window
+RECENTLY_ACTIVE_WINDOW = 60
+
+TORRENT_LIST_PAGE = 15
+
+# Fields polled for torrents added through the bot, until they finish
+WATCH_FIELDS = ('id', 'percentDone', 'doneDate', 'rateDownload', 'error', 'errorString')
+
+# Transmission error codes: 1 is a tracker warning, 2 a tracker error and 3 a
+#  local error (e.g. the disk is full), which stops the torrent
+TR_STAT_TRACKER_WARNING = 1
+
 # UNIX epochs to be turned into UTC datetimes
 TIMESTAMP_KEYS = frozenset(
     ['activityDate',
@@ -34,18 +70,24 @@ TIMESTAMP_KEYS = frozenset(
 
 
 class UTC(datetime.tzinfo):
+    ZERO = datetime.timedelta(0)
+
     def utcoffset(self, dt):
-        return datetime.timedelta(0)
+        return self.ZERO
 
     def tzname(self, dt):
         return 'UTC'
 
     def dst(self, dt):
-        return datetime.timedelta(0)
+        return self.ZERO
+
+
+# tzinfo instances are immutable, so every datetime can share one
+UTC_TZ = UTC()
 
 
 def epoch_to_datetime(value):
-    return datetime.datetime.fromtimestamp(value, UTC())
+    return datetime.datetime.fromtimestamp(value, UTC_TZ)
 
 
 def datetime_to_epoch(value):
@@ -58,14 +100,24 @@ def datetime_to_epoch(value):
 
 class TransmissionJSONDecoder(json.JSONDecoder):
     def __init__(self, **kwargs):
+        # Timestamps repeat a lot within a response (0 for never, trackers
+        #  announcing together), so each distinct one is only converted once
+        self.datetimes = {}
         return super(TransmissionJSONDecoder, self).__init__(
             object_hook=self.object_hook, **kwargs)
 
     def object_hook(self, obj):
-        for key, value in obj.items():
-            if key in TIMESTAMP_KEYS:
-                value = epoch_to_datetime(value)
-            obj[key] = value
+        # Most objects in a large response (files, peers, ...) have none of
+        #  the timestamp keys, so leave those untouched
+        if TIMESTAMP_KEYS.isdisjoint(obj):
+            return obj
+
+        for key in TIMESTAMP_KEYS.intersection(obj):
+            value = obj[key]
+            converted = self.datetimes.get(value)
+            if converted is None:
+                converted = self.datetimes[value] = epoch_to_datetime(value)
+            obj[key] = converted
         return obj
 
 
@@ -80,39 +132,74 @@ class TransmissionJSONEncoder(json.JSONEncoder):
 
 class TransmissionClient(object):
     def __init__(self, url, path='/transmission/rpc',
-                 username=None, password=None):
+                 username=None, password=None,
+                 timeout=(5, 30), pool_size=4, max_session_retries=2):
         """
         Initialize the Transmission client.
         The default host, port and path are all set to Transmission's
-        default.
+        default. Requests go through a single keep-alive session, holding up
+        to `pool_size` connections.
         """
         self.url = url + path
         self.headers = {}
         self.tag = 0
+        # Configs loaded from JSON/YAML give a list, requests wants a tuple
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        self.max_session_retries = max_session_retries
 
-        self.auth = None
+        self.session = requests.Session()
+        self.session.verify = False
         if username or password:
-            self.auth = (username, password)
+            self.session.auth = (username, password)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # RPC latency per method, and how often we had to refresh the session
+        #  id or failed outright
+        self.latency = defaultdict(Histogram)
+        self.session_retries = 0
+        self.errors = 0
 
     def __call__(self, method, **kwargs):
         """
         Send request to Transmission's RPC interface.
         """
-        response = self._make_request(method, **kwargs)
-        return self._deserialize_response(response)
+        # Tags are handed out per request, so concurrent calls can share the client
+        tag = self.tag
+        self.tag += 1
 
-    def _make_request(self, method, **kwargs):
-        body = json.dumps(self._format_request_body(method, **kwargs), cls=TransmissionJSONEncoder)
-        r = requests.post(self.url, data=body, headers=self.headers, auth=self.auth, verify=False)
+        try:
+            with self.latency[method].time():
+                response = self._make_request(method, tag, **kwargs)
+            return self._deserialize_response(response, tag)
+        except Exception:
+            self.errors += 1
+            raise
 
-        if r.status_code == CSRF_ERROR_CODE:
-            self.headers[CSRF_HEADER] = r.headers[CSRF_HEADER]
-            return self._make_request(method, **kwargs)
+    def close(self):
+        self.session.close()
 
-        r.raise_for_status()
-        return r
+    def _make_request(self, method, tag, **kwargs):
+        body = json.dumps(self._format_request_body(method, tag, **kwargs), cls=TransmissionJSONEncoder)
 
-    def _format_request_body(self, method, **kwargs):
+        for _ in range(self.max_session_retries + 1):
+            r = self.session.post(self.url, data=body, headers=self.headers, timeout=self.timeout)
+
+            # Transmission rejects requests without a current session id,
+            #  handing out the current one with the rejection
+            if r.status_code == CSRF_ERROR_CODE:
+                self.headers[CSRF_HEADER] = r.headers[CSRF_HEADER]
+                self.session_retries += 1
+                continue
+
+            r.raise_for_status()
+            return r
+
+        raise Exception('Transmission rejected the session id {} times'.format(self.max_session_retries + 1))
+
+    def _format_request_body(self, method, tag, **kwargs):
         """
         Create a request object to be serialized and sent to Transmission.
         """
@@ -121,9 +208,9 @@ class TransmissionClient(object):
         # underscores with them here.
         for k, v in kwargs.items():
             fixed[k.replace('_', '-')] = v
-        return {"method": method, "tag": self.tag, "arguments": fixed}
+        return {"method": method, "tag": tag, "arguments": fixed}
 
-    def _deserialize_response(self, response):
+    def _deserialize_response(self, response, tag):
         """
         Return the response generated by the request object, raising
         BadRequest if there were any problems.
@@ -133,16 +220,125 @@ class TransmissionClient(object):
         if doc['result'] != 'success':
             raise Exception('Request failed: `%s`' % doc['result'])
 
-        if doc['tag'] != self.tag:
-            raise Exception('Tag mismatch: (got %s expected %s)' % (doc['tag'], self.tag))
-        else:
-            self.tag += 1
+        if doc['tag'] != tag:
+            raise Exception('Tag mismatch: (got %s expected %s)' % (doc['tag'], tag))
 
         if 'arguments' in doc:
             return doc['arguments'] or None
         return None
 
 
+def fmt_eta(seconds):
+    if seconds < 0:
+        return '-'
+    if seconds < 3600:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}h{:02d}m'.format(seconds // 3600, (seconds % 3600) // 60)
+
+
+def fmt_torrent_status(torrent):
+    if torrent['error']:
+        return 'error'
+    return TORRENT_STATUS[torrent['status']] if torrent['status'] < len(TORRENT_STATUS) else 'unknown'
+
+
+class TorrentCache(object):
+    """
+    A local copy of the daemon's torrents, holding only `fields`. The first
+    sync fetches every torrent; after that only the torrents that were active
+    since the last sync are fetched, along with the ids of removed ones. If
+    the cache fell too far behind for that to be complete, it resyncs fully.
+    """
+    def __init__(self, client, fields=STATUS_FIELDS, max_age=5):
+        self.client = client
+        self.fields = list(fields)
+        self.max_age = max_age
+
+        self.torrents = {}
+        self.synced_at = None
+        self.lock = Semaphore()
+
+        self.full_syncs = 0
+        self.delta_syncs = 0
+
+    def refresh(self, force=False):
+        with self.lock:
+            # Someone else synced while we waited, or recently enough anyway
+            if not force and self.synced_at and time.time() - self.synced_at < self.max_age:
+                return self.torrents
+
+            started_at = time.time()
+            if self.synced_at is None or started_at - self.synced_at >= RECENTLY_ACTIVE_WINDOW:
+                result = self.client('torrent-get', fields=self.fields)
+                self.torrents = {torrent['id']: torrent for torrent in result['torrents']}
+                self.full_syncs += 1
+            else:
+                result = self.client('torrent-get', ids='recently-active', fields=self.fields)
+                for torrent in result['torrents']:
+                    self.torrents[torrent['id']] = torrent
+                for torrent_id in result.get('removed', []):
+                    self.torrents.pop(torrent_id, None)
+                self.delta_syncs += 1
+
+            self.synced_at = started_at
+            return self.torrents
+
+    def find(self, query):
+        """
+        Finds torrents by id, hash (prefix) or name (substring).
+        """
+        torrents = self.refresh()
+        if query.isdigit() and int(query) in torrents:
+            return [torrents[int(query)]]
+
+        query = query.lower()
+        return [
+            torrent for torrent in sorted(torrents.values(), key=lambda t: t['id'])
+            if torrent['hashString'].startswith(query) or query in torrent['name'].lower()
+        ]
+
+
+class TTLCache(object):
+    """
+    A mapping holding up to `max_size` entries for `ttl` seconds each,
+    evicting the least recently used entry when full.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+
+        # Re-inserting moves it to the most recently used end
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time(), value)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
 class TorrentPluginConfig(Config):
     user_id = None
     token = None
@@ -152,18 +348,143 @@ class TorrentPluginConfig(Config):
     transmission_password = None
     transmission_url = None
 
+    # Transmission RPC (connect, read) timeouts in seconds, and how many
+    #  connections to keep open to it
+    transmission_timeout = (5, 30)
+    transmission_pool_size = 4
+
+    # How often (in seconds) the torrent status cache syncs in the background,
+    #  keeping it within the window where delta syncs are possible
+    status_sync_interval = 30
+
+    # Bounds (in seconds) for how often torrents added through the bot are
+    #  polled. Polling speeds up while they download, and backs off when idle.
+    watch_min_interval = 5
+    watch_max_interval = 120
+
+    # How many searches are kept, and for how long (in seconds), so repeating
+    #  one doesn't hit the tracker again
+    search_cache_size = 128
+    search_cache_ttl = 600
+
+    # How long (in seconds) a user's last search results can be downloaded
+    #  from in a channel
+    result_session_ttl = 900
+    result_session_size = 256
+
 
 @Plugin.with_config(TorrentPluginConfig)
 class TorrentPlugin(Plugin):
     def load(self, ctx):
         super(TorrentPlugin, self).load(ctx)
         self._session = None
-        self.last = None
+
+        # Parsed search results by query, and each (channel, user)'s last ones
+        self.search_cache = ctx.get('torrent_search_cache') or TTLCache(
+            self.config.search_cache_size, self.config.search_cache_ttl)
+        self.result_sessions = ctx.get('torrent_result_sessions') or TTLCache(
+            self.config.result_session_size, self.config.result_session_ttl)
         self.client = TransmissionClient(
             url=self.config.transmission_url,
             username=self.config.transmission_username,
             password=self.config.transmission_password,
+            timeout=self.config.transmission_timeout,
+            pool_size=self.config.transmission_pool_size,
         )
+        self.torrents = TorrentCache(self.client)
+        if self.config.transmission_url and self.config.status_sync_interval:
+            self.register_schedule(self.sync_torrents, self.config.status_sync_interval, init=False)
+
+        # Torrents added through the bot which haven't finished, by id
+        self.watching = ctx.get('torrent_watching') or {}
+        self.watch_wakeup = Event()
+        self.spawn(self.watch_downloads)
+
+    def unload(self, ctx):
+        ctx['torrent_watching'] = self.watching
+        ctx['torrent_search_cache'] = self.search_cache
+        ctx['torrent_result_sessions'] = self.result_sessions
+        self.client.close()
+        super(TorrentPlugin, self).unload(ctx)
+
+    def sync_torrents(self):
+        try:
+            self.torrents.refresh(force=True)
+        except Exception:
+            self.log.exception('Failed to sync torrent status: ')
+
+    def watch(self, torrent, channel_id):
+        self.watching[torrent['id']] = {
+            'name': torrent['name'],
+            'hash': torrent['hashString'],
+            'channel': channel_id,
+            'progress': None,
+        }
+        self.watch_wakeup.set()
+
+    def watch_downloads(self):
+        """
+        Polls the watched torrents, all in one request, notifying their channels
+        as they finish or fail. Polls every `watch_min_interval` seconds while
+        any of them progresses, doubling up to `watch_max_interval` while none
+        do, and sleeps until something is watched when there's nothing to.
+        """
+        interval = self.config.watch_min_interval
+        while True:
+            if self.watch_wakeup.wait(timeout=interval if self.watching else None):
+                interval = self.config.watch_min_interval
+            self.watch_wakeup.clear()
+
+            if not self.watching:
+                continue
+
+            try:
+                active = self.check_downloads()
+            except Exception:
+                self.log.exception('Failed to poll %s watched torrents: ', len(self.watching))
+                active = False
+
+            if active:
+                interval = self.config.watch_min_interval
+            else:
+                interval = min(interval * 2, self.config.watch_max_interval)
+
+    def check_downloads(self):
+        """
+        Returns whether any watched torrent made progress since the last poll.
+        Torrents watched while the request is in flight wait for the next one.
+        """
+        watching = list(self.watching.items())
+        result = self.client(
+            'torrent-get', ids=[torrent_id for torrent_id, _ in watching], fields=list(WATCH_FIELDS))
+        found = {torrent['id']: torrent for torrent in result['torrents']}
+
+        active = False
+        for torrent_id, watched in watching:
+            torrent = found.get(torrent_id)
+            if not torrent:
+                self.notify(watched, 'Torrent `{}` was removed before it finished'.format(watched['name']))
+            elif torrent['error'] > TR_STAT_TRACKER_WARNING:
+                self.notify(watched, 'Torrent `{}` failed: `{}`'.format(watched['name'], torrent['errorString']))
+            elif torrent['percentDone'] >= 1:
+                self.notify(watched, 'Finished downloading `{}` (hash {})'.format(watched['name'], watched['hash']))
+            else:
+                if torrent['rateDownload'] or torrent['percentDone'] != watched['progress']:
+                    active = True
+                watched['progress'] = torrent['percentDone']
+                continue
+
+            # Unless it was downloaded (and watched) again while we notified
+            if self.watching.get(torrent_id) is watched:
+                del self.watching[torrent_id]
+
+        return active
+
+    def notify(self, watched, content):
+        try:
+            self.bot.client.api.channels_messages_create(watched['channel'], content)
+        except APIException:
+            self.log.exception('Failed to notify channel %s: ', watched['channel'])
 
     @property
     def cookies(self):
@@ -175,12 +496,18 @@ class TorrentPlugin(Plugin):
 
     @Plugin.command('search', '<name:str...>', group='torrent', level=CommandLevels.TRUSTED)
     def search(self, event, name):
-        r = requests.get(SEARCH_URL, params=urllib.urlencode({
-            'q': name,
-        }), cookies=self.cookies)
-        r.raise_for_status()
+        query = normalize_query(name)
+        torrents = self.search_cache.get(query)
+
+        if torrents is None:
+            r = requests.get(SEARCH_URL, params=urllib.urlencode({
+                'q': query,
+            }), cookies=self.cookies)
+            r.raise_for_status()
+
+            torrents = list(self._torrents_from_html(r.content))
+            self.search_cache.set(query, torrents)
 
-        torrents = list(self._torrents_from_html(r.content))
         if not len(torrents):
             return event.msg.reply('No results')
 
@@ -188,11 +515,18 @@ class TorrentPlugin(Plugin):
             '\n'.join(['{0}  {1} ({3})'.format(idx, *torrent) for idx, torrent in enumerate(torrents[:10])])
         ))
 
-        self.last = torrents
+        self.result_sessions.set((event.msg.channel_id, event.msg.author.id), torrents)
 
     @Plugin.command('download', '<id:int>', group='torrent', level=CommandLevels.TRUSTED)
     def download(self, event, id):
-        obj = self.last[id]
+        torrents = self.result_sessions.get((event.msg.channel_id, event.msg.author.id))
+        if torrents is None:
+            return event.msg.reply('No recent search results here, use `torrent search` first')
+
+        if not 0 <= id < len(torrents):
+            return event.msg.reply('Invalid result, pick one between 0 and {}'.format(len(torrents) - 1))
+
+        obj = torrents[id]
         r = requests.get(BASE_URL + obj[1], cookies=self.cookies)
         r.raise_for_status()
         r = self.client('torrent-add',
@@ -200,18 +534,105 @@ class TorrentPlugin(Plugin):
             paused=False,
             peer_limit=500)
 
-        hsh = None
-        if 'torrent-added' in r:
-            hsh = r['torrent-added']['hashString']
-        elif 'torrent-duplicate' in r:
-            hsh = r['torrent-duplicate']['hashString']
+        torrent = r.get('torrent-added') or r.get('torrent-duplicate')
 
-        if hsh:
-            event.msg.reply('Ok, downloading torrent with hash {}'.format(hsh))
+        if torrent:
+            self.watch(torrent, event.msg.channel_id)
+            event.msg.reply('Ok, downloading torrent with hash {}'.format(torrent['hashString']))
         else:
             event.msg.reply('Error: ```{}```'.format(r))
 
+    @Plugin.command('rpc', group='torrent', level=CommandLevels.TRUSTED)
+    def rpc_stats(self, event):
+        table = MessageTable()
+        table.set_header('Method', 'Count', 'Mean', 'p50', 'p99', 'Max')
+
+        for method, hist in sorted(self.client.latency.items()):
+            table.add(
+                method,
+                hist.count,
+                fmt_duration(hist.mean),
+                fmt_duration(hist.percentile(50)),
+                fmt_duration(hist.percentile(99)),
+                fmt_duration(hist.max))
+
+        event.msg.reply(
+            'Session id refreshes: `{}`, errors: `{}`, status syncs: `{}` full, `{}` delta, watching: `{}`\n{}'.format(
+                self.client.session_retries,
+                self.client.errors,
+                self.torrents.full_syncs,
+                self.torrents.delta_syncs,
+                len(self.watching),
+                table.compile()))
+
+    @Plugin.command('cache', group='torrent', level=CommandLevels.TRUSTED)
+    def cache_stats(self, event):
+        table = MessageTable()
+        table.set_header('Cache', 'Entries', 'Hits', 'Misses', 'Hit Rate', 'Evictions')
+
+        for name, cache in (('search', self.search_cache), ('sessions', self.result_sessions)):
+            lookups = cache.hits + cache.misses
+            table.add(
+                name,
+                len(cache),
+                cache.hits,
+                cache.misses,
+                '{:.1f}%'.format(cache.hits * 100.0 / lookups) if lookups else '-',
+                cache.evictions)
+
+        event.msg.reply('Tracker searches saved: `{}`\n{}'.format(self.search_cache.hits, table.compile()))
+
+    @Plugin.command('list', '[page:int]', group='torrent', level=CommandLevels.TRUSTED)
+    def list_torrents(self, event, page=1):
+        torrents = sorted(self.torrents.refresh().values(), key=lambda t: t['addedDate'], reverse=True)
+        pages = max(1, (len(torrents) + TORRENT_LIST_PAGE - 1) // TORRENT_LIST_PAGE)
+        page = min(max(page, 1), pages)
+
+        table = MessageTable()
+        table.set_header('ID', 'Name', 'Status', 'Done', 'Down', 'Up', 'ETA')
+        for torrent in torrents[(page - 1) * TORRENT_LIST_PAGE:page * TORRENT_LIST_PAGE]:
+            table.add(
+                torrent['id'],
+                torrent['name'][:40],
+                fmt_torrent_status(torrent),
+                '{:.1f}%'.format(torrent['percentDone'] * 100),
+                sizeof_fmt(torrent['rateDownload'], 'B/s'),
+                sizeof_fmt(torrent['rateUpload'], 'B/s'),
+                fmt_eta(torrent['eta']))
+
+        event.msg.reply('{} torrents, {} downloading (page {}/{})\n{}'.format(
+            len(torrents),
+            sum(1 for t in torrents if t['status'] == TORRENT_STATUS.index('downloading')),
+            page,
+            pages,
+            table.compile()))
+
+    @Plugin.command('status', '<query:str...>', group='torrent', level=CommandLevels.TRUSTED)
+    def torrent_status(self, event, query):
+        torrents = self.torrents.find(query)
+        if not torrents:
+            return event.msg.reply('No torrent matches `{}`'.format(query))
+
+        lines = []
+        for torrent in torrents[:5]:
+            lines.append(u'**{}** (#{}, `{}`)'.format(torrent['name'], torrent['id'], torrent['hashString'][:12]))
+            lines.append(u'  {}, {:.1f}% of {}, {} down, {} up, ETA {}'.format(
+                fmt_torrent_status(torrent),
+                torrent['percentDone'] * 100,
+                sizeof_fmt(torrent['totalSize']),
+                sizeof_fmt(torrent['rateDownload'], 'B/s'),
+                sizeof_fmt(torrent['rateUpload'], 'B/s'),
+                fmt_eta(torrent['eta'])))
+            if torrent['error']:
+                lines.append(u'  Error: `{}`'.format(torrent['errorString']))
+
+        if len(torrents) > 5:
+            lines.append('...and {} more'.format(len(torrents) - 5))
+        event.msg.reply('\n'.join(lines))
+
     def _torrents_from_html(self, raw):
+        from pyquery import PyQuery as PQ
+
         q = PQ(raw)
 
         torrents = q("#torrents")("tr")
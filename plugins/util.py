@@ -1,43 +1,172 @@
 import gevent
-import gc
-import sys
 import time
 import pprint
 
-from collections import Counter, defaultdict
+from collections import defaultdict, deque
 
-from disco.bot import Plugin, CommandLevels
-from disco.util.snowflake import to_datetime
+from gevent.lock import Semaphore
+from gevent.pool import Pool
+from disco.api.http import APIException
+from disco.bot import Plugin, Config, CommandLevels
+from disco.util.snowflake import to_datetime, to_unix
 from disco.types.permissions import Permissions
 from disco.types.message import MessageTable
 from disco.types.user import GameType, Status, Game
 from disco.util.functional import take
 
+from plugins import instrument, memory
+from plugins.metrics import RateCounter, HyperLogLog, fmt_duration, sizeof_fmt
+from plugins.monitor import BlockingMonitor, Sampler
+
 PY_CODE_BLOCK = '```py\n{}\n```'
 
 
-def sizeof_fmt(num, suffix='B'):
-    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+class UtilPluginConfig(Config):
+    # Greenlets holding the hub for longer than this (in seconds) are recorded
+    #  as blocking it, along with their stack. Set to None to disable.
+    blocking_threshold = 0.1
+    blocking_history = 50
 
 
+@Plugin.with_config(UtilPluginConfig)
 class UtilPlugin(Plugin):
+    # How often the unique id sketches are rebuilt from the state (sketches
+    #  can't forget ids, so this is what drops guilds/channels/users we lost)
+    SKETCH_REBUILD_INTERVAL = 15 * 60
+
+    # Ids hashed between yields to the hub while rebuilding
+    SKETCH_REBUILD_CHUNK = 5000
+
+    # How often a heap snapshot is taken for debug memdiff, and how many are kept
+    HEAP_SNAPSHOT_INTERVAL = 30 * 60
+    HEAP_SNAPSHOT_HISTORY = 12
+
+    # Own message ids remembered per channel for clean
+    OWN_MESSAGE_INDEX_SIZE = 500
+
+    # Discord only bulk deletes up to 100 messages at once, none of them older
+    #  than two weeks (less a margin for clock skew and slow batches)
+    BULK_DELETE_LIMIT = 100
+    BULK_DELETE_MAX_AGE = 14 * 24 * 3600 - 600
+
+    # Single deletes in flight at once, and how often progress is reported
+    CLEAN_CONCURRENCY = 5
+    CLEAN_PROGRESS_INTERVAL = 2
+
+    # Longest window (in seconds) debug profile will sample for
+    PROFILE_MAX_SECONDS = 120
+
     def load(self, ctx):
         super(UtilPlugin, self).load(ctx)
         self.event_counter = ctx.get('event_counter') or defaultdict(int)
+        self.event_rates = ctx.get('event_rates') or defaultdict(RateCounter)
         self.startup = ctx.get('startup') or time.time()
+        self.sketches = ctx.get('sketches')
+        if self.sketches is None:
+            # Loaded into a running bot, the state already holds everything the
+            #  listeners would have added, so seed from it rather than waiting
+            #  for the first scheduled rebuild
+            self.sketches = {'channels': HyperLogLog(), 'users': HyperLogLog()}
+            self.spawn(self.rebuild_sketches)
+        self.register_schedule(self.rebuild_sketches, self.SKETCH_REBUILD_INTERVAL, init=False)
+
+        self.heap_lock = Semaphore()
+        self.heap_snapshots = ctx.get('heap_snapshots') or deque(maxlen=self.HEAP_SNAPSHOT_HISTORY)
+        self.register_schedule(self.record_heap_snapshot, self.HEAP_SNAPSHOT_INTERVAL, init=False)
+
+        self.own_messages = ctx.get('own_messages') or defaultdict(
+            lambda: deque(maxlen=self.OWN_MESSAGE_INDEX_SIZE))
+        self.profile_lock = Semaphore()
+        instrument.install(self.bot)
+
+        self.blocking = None
+        if self.config.blocking_threshold:
+            self.blocking = BlockingMonitor(self.config.blocking_threshold, self.config.blocking_history)
+            self.blocking.start()
 
     def unload(self, ctx):
+        if self.blocking:
+            self.blocking.stop()
+
         ctx['event_counter'] = self.event_counter
+        ctx['event_rates'] = self.event_rates
         ctx['startup'] = self.startup
+        ctx['sketches'] = self.sketches
+        ctx['heap_snapshots'] = self.heap_snapshots
+        ctx['own_messages'] = self.own_messages
         super(UtilPlugin, self).unload(ctx)
 
+    def all_shards(self, func):
+        if self.bot.shards:
+            return self.bot.shards.all(func)
+        return {0: func(self.bot)}
+
+    def rebuild_sketches(self):
+        sketches = {'channels': HyperLogLog(), 'users': HyperLogLog()}
+
+        for key, ids in (('channels', self.state.channels), ('users', self.state.users)):
+            ids = list(ids.keys())
+            for idx in range(0, len(ids), self.SKETCH_REBUILD_CHUNK):
+                sketches[key].update(ids[idx:idx + self.SKETCH_REBUILD_CHUNK])
+                gevent.sleep(0)
+
+        # Anything seen while we were rebuilding is in the state as well
+        self.sketches = sketches
+
+    def take_heap_snapshot(self):
+        # Only one walk at a time, they'd just slow each other down
+        with self.heap_lock:
+            return memory.walk_heap()
+
+    def record_heap_snapshot(self):
+        # Only the periodic snapshots are kept, so the history stays evenly
+        #  spaced no matter how often the commands are run
+        self.heap_snapshots.append(self.take_heap_snapshot())
+
     @Plugin.listen('')
     def on_any_event(self, event):
-        self.event_counter[event.__class__.__name__] += 1
+        name = event.__class__.__name__
+        self.event_counter[name] += 1
+        self.event_rates[name].hit()
+
+    @Plugin.listen('MessageCreate')
+    def on_message_create(self, event):
+        if self.state.me and event.author.id == self.state.me.id:
+            self.own_messages[event.channel_id].append(event.id)
+
+    @Plugin.listen('MessageDelete')
+    def on_message_delete(self, event):
+        index = self.own_messages.get(event.channel_id)
+        if index and event.id in index:
+            index.remove(event.id)
+
+    @Plugin.listen('MessageDeleteBulk')
+    def on_message_delete_bulk(self, event):
+        index = self.own_messages.get(event.channel_id)
+        if index:
+            ids = set(event.ids)
+            self.own_messages[event.channel_id] = deque((i for i in index if i not in ids), index.maxlen)
+
+    @Plugin.listen('GuildCreate')
+    def on_guild_create(self, event):
+        self.sketches['channels'].update(event.guild.channels.keys())
+        self.sketches['users'].update(event.guild.members.keys())
+
+    @Plugin.listen('ChannelCreate')
+    def on_channel_create(self, event):
+        self.sketches['channels'].add(event.channel.id)
+
+    @Plugin.listen('GuildMemberAdd')
+    def on_guild_member_add(self, event):
+        self.sketches['users'].add(event.member.id)
+
+    @Plugin.listen('GuildMembersChunk')
+    def on_guild_members_chunk(self, event):
+        self.sketches['users'].update(member.id for member in event.members)
+
+    @Plugin.listen('PresenceUpdate')
+    def on_presence_update(self, event):
+        self.sketches['users'].add(event.presence.user.id)
 
     @Plugin.command('info', '<user:user>')
     def command_info(self, event, user):
@@ -97,46 +226,55 @@ class UtilPlugin(Plugin):
     def debug_events(self, event, size=50):
         name = self.name
 
-        def get_event_count(bot):
-            return bot.plugins[name].event_counter
+        def get_event_rates(bot):
+            return {k: v.snapshot() for k, v in bot.plugins[name].event_rates.items()}
 
-        obj = sum(map(Counter, self.bot.shards.all(get_event_count).values()), Counter())
+        # Rates (and peaks) are summed across shards
+        obj = {}
+        for rates in self.all_shards(get_event_rates).values():
+            for event_name, snapshot in rates.items():
+                obj[event_name] = [a + b for a, b in zip(obj.get(event_name, [0] * len(snapshot)), snapshot)]
 
         table = MessageTable()
-        table.set_header('Event', 'Count', 'Per Minute', 'Per Second')
-
-        runtime = max(1, int((time.time() - self.startup) / 60))
+        table.set_header('Event', 'Count', 'Now/s', '1m/s', '5m/s', '15m/s', 'Peak/s')
 
-        for name, count in sorted(obj.items(), key=lambda i: i[1], reverse=True)[:size]:
-            table.add(name, count, count / runtime, (count / runtime) / 60)
+        for name, snapshot in sorted(obj.items(), key=lambda i: i[1][0], reverse=True)[:size]:
+            total, rates = snapshot[0], snapshot[1:]
+            table.add(name, total, *['{:.2f}'.format(rate) for rate in rates])
 
         event.msg.reply(table.compile())
 
     @Plugin.command('shards', group='debug', level=CommandLevels.TRUSTED)
     def debug_shards(self, event):
         msg = event.msg.reply('One moment, collecting shard information...')
+        name = self.name
+
+        def get_shard_info(bot):
+            state = bot.client.state
+            return (
+                (len(state.guilds), len(state.channels), len(state.users)),
+                {k: v.dumps() for k, v in bot.plugins[name].sketches.items()},
+            )
 
         table = MessageTable()
         table.set_header('Shard', 'Guilds', 'Channels', 'Users')
 
-        guilds_uniq = set()
-        channels_uniq = set()
-        users_uniq = set()
-
-        guilds = self.bot.shards.all(lambda bot: list(bot.client.state.guilds.keys()))
-        channels = self.bot.shards.all(lambda bot: list(bot.client.state.channels.keys()))
-        users = self.bot.shards.all(lambda bot: list(bot.client.state.users.keys()))
-
-        for shard in self.bot.shards.keys():
-            table.add(shard, len(guilds[shard]), len(channels[shard]), len(users[shard]))
-            guilds_uniq |= set(guilds[shard])
-            channels_uniq |= set(channels[shard])
-            users_uniq |= set(users[shard])
-
-        msg.edit(table.compile() + '\n' + 'Unique Guilds: `{}`, Unique Channels: `{}`, Unique Users: `{}`'.format(
-            len(guilds_uniq),
-            len(channels_uniq),
-            len(users_uniq),
+        # A guild (and its channels) lives on exactly one shard, so guilds can
+        #  be summed. DM channels and users can show up on several, so their
+        #  unique counts are estimated from the merged sketches.
+        guilds_uniq = 0
+        sketches = {'channels': HyperLogLog(), 'users': HyperLogLog()}
+
+        for shard, (counts, shard_sketches) in sorted(self.all_shards(get_shard_info).items()):
+            table.add(shard, *counts)
+            guilds_uniq += counts[0]
+            for key, data in shard_sketches.items():
+                sketches[key].merge(HyperLogLog.loads(data))
+
+        msg.edit(table.compile() + '\n' + 'Unique Guilds: `{}`, Unique Channels: `~{}`, Unique Users: `~{}`'.format(
+            guilds_uniq,
+            len(sketches['channels']),
+            len(sketches['users']),
         ))
 
     @Plugin.command('status', group='debug', level=CommandLevels.TRUSTED)
@@ -158,41 +296,271 @@ class UtilPlugin(Plugin):
             pass
 
         table.add('Greenlets', gevent.get_hub().loop.activecnt)
+
+        if self.blocking:
+            table.add('Hub Blocks (>{}ms)'.format(int(self.blocking.threshold * 1000)), self.blocking.count)
+
         event.msg.reply(table.compile())
 
+    @Plugin.command('blocking', '[index:int]', group='debug', level=CommandLevels.TRUSTED)
+    def debug_blocking(self, event, index=None):
+        """
+        Lists the most recent times a greenlet blocked the hub, or shows the
+        stack of one of them.
+        """
+        if not self.blocking:
+            event.msg.reply('Blocking monitor is disabled')
+            return
+
+        recent = list(reversed(self.blocking.recent()))
+        if not recent:
+            event.msg.reply('No greenlet has blocked the hub for over {}ms'.format(
+                int(self.blocking.threshold * 1000)))
+            return
+
+        if index is not None:
+            if not 0 < index <= len(recent):
+                event.msg.reply('Only have {} blocking event(s)'.format(len(recent)))
+                return
+
+            block = recent[index - 1]
+            event.msg.reply('`{}` blocked the hub for {} in `{}.{}`\n{}'.format(
+                block.greenlet,
+                fmt_duration(block.duration),
+                block.plugin,
+                block.handler,
+                PY_CODE_BLOCK.format(block.stack[-1800:]),
+            ))
+            return
+
+        now = time.time()
+        table = MessageTable()
+        table.set_header('#', 'Ago', 'Blocked', 'Plugin', 'Handler')
+        for idx, block in enumerate(recent[:15], 1):
+            table.add(
+                idx,
+                '{:.0f}s'.format(now - block.started_at),
+                fmt_duration(block.duration),
+                block.plugin or '-',
+                block.handler or '-')
+
+        event.msg.reply('{} block(s) since load\n{}'.format(self.blocking.count, table.compile()))
+
+    @Plugin.command('handlers', '[by:str] [size:int]', group='debug', level=CommandLevels.TRUSTED)
+    def debug_handlers(self, event, by='handler', size=15):
+        """
+        Shows how long handlers (or handlers per event type, with `event`) take
+        and how long events waited before a handler started, by total time.
+        """
+        by = 'event' if by.startswith('event') else 'handler'
+        totals = instrument.summarize(by)
+
+        table = MessageTable()
+        table.set_header(by.title(), 'Calls', 'Total', 'Mean', 'p99', 'Max', 'Delay p99')
+        for key, value in sorted(totals.items(), key=lambda i: i[1].latency.sum, reverse=True)[:size]:
+            latency = value.latency
+            table.add(
+                '.'.join(key) if by == 'handler' else key,
+                latency.count,
+                fmt_duration(latency.sum),
+                fmt_duration(latency.mean),
+                fmt_duration(latency.percentile(99)),
+                fmt_duration(latency.max),
+                fmt_duration(value.delay.percentile(99)) if value.delay.count else '-')
+
+        event.msg.reply(table.compile())
+
+    @Plugin.command('profile', '[seconds:float] [size:int]', group='debug', level=CommandLevels.TRUSTED)
+    def debug_profile(self, event, seconds=10.0, size=10):
+        """
+        Samples what the bot is doing for a number of seconds, replying with
+        the top handlers/functions and the collapsed stacks as an attachment.
+        """
+        if not 0 < seconds <= self.PROFILE_MAX_SECONDS:
+            event.msg.reply('Can only profile for up to {} seconds'.format(self.PROFILE_MAX_SECONDS))
+            return
+
+        if not self.profile_lock.acquire(blocking=False):
+            event.msg.reply('A profile is already running')
+            return
+
+        try:
+            msg = event.msg.reply('Profiling for {:g} seconds...'.format(seconds))
+            sampler = Sampler().profile(seconds)
+        finally:
+            self.profile_lock.release()
+
+        if not sampler.samples:
+            msg.edit('No samples were taken')
+            return
+
+        def top(counter, header):
+            table = MessageTable()
+            table.set_header(header, 'Samples', '%')
+            for name, count in counter.most_common(size):
+                table.add(name, count, '{:.1f}'.format(count * 100.0 / sampler.samples))
+            return table.compile()
+
+        msg.delete()
+        event.msg.reply(
+            '{} samples over {:g}s\n{}\n{}'.format(
+                sampler.samples, seconds, top(sampler.handlers, 'Handler'), top(sampler.functions, 'Function')),
+            attachment=('profile-{}.folded'.format(int(time.time())), sampler.collapsed()))
+
     @Plugin.command('objects', group='debug', level=CommandLevels.TRUSTED)
     def debug_memory(self, event):
-        by_count = Counter()
-        by_size = Counter()
-
-        for obj in gc.get_objects():
-            size = sys.getsizeof(obj)
-            by_count[type(obj).__name__] += 1
-            by_size[type(obj).__name__] += size
+        snapshot = self.take_heap_snapshot()
 
         codeblock = '```python\n{}\n```'
-        event.msg.reply('\nBy Count: {}\n By Size: {}\n'.format(
-            codeblock.format('\n'.join('{}: {}'.format(k, v) for k, v in by_count.most_common(15))),
-            codeblock.format('\n'.join('{}: {}'.format(k, v) for k, v in by_size.most_common(15))),
+        event.msg.reply('\nBy Count: {}\n By Size: {}\n`{} objects, {} (walked in {:.2f}s)`'.format(
+            codeblock.format('\n'.join('{}: {}'.format(k, v[0]) for k, v in snapshot.top('count'))),
+            codeblock.format('\n'.join('{}: {}'.format(k, v[1]) for k, v in snapshot.top('size'))),
+            snapshot.count,
+            sizeof_fmt(snapshot.size),
+            snapshot.duration,
         ))
 
+    @Plugin.command('memdiff', '[snapshot:int] [size:int]', group='debug', level=CommandLevels.TRUSTED)
+    def debug_memdiff(self, event, snapshot=1, size=15):
+        """
+        Shows the per-type heap growth since an earlier periodic snapshot (1
+        being the most recent one).
+        """
+        if not 0 < snapshot <= len(self.heap_snapshots):
+            event.msg.reply('Only have {} snapshot(s) to compare against'.format(len(self.heap_snapshots)))
+            return
+
+        older = self.heap_snapshots[-snapshot]
+        current = self.take_heap_snapshot()
+
+        def signed_size(num):
+            return ('-' if num < 0 else '+') + sizeof_fmt(abs(num))
+
+        table = MessageTable()
+        table.set_header('Type', 'Count', 'Size')
+        for name, count, size_delta in current.diff(older)[:size]:
+            table.add(name, '{:+d}'.format(count), signed_size(size_delta))
+
+        lines = [
+            'Since {:.0f} minutes ago: `{:+d}` objects, `{}`'.format(
+                (current.taken_at - older.taken_at) / 60,
+                current.count - older.count,
+                signed_size(current.size - older.size)),
+            table.compile(),
+        ]
+
+        modules = current.diff_modules(older)
+        if modules:
+            table = MessageTable()
+            table.set_header('Module', 'Allocated')
+            for name, size_delta in modules[:size]:
+                table.add(name, signed_size(size_delta))
+            lines.append(table.compile())
+
+        event.msg.reply('\n'.join(lines))
+
+    @Plugin.command('tracemalloc', '<enabled:str>', group='debug', level=CommandLevels.OWNER)
+    def debug_tracemalloc(self, event, enabled):
+        """
+        Toggles tracemalloc, so heap snapshots attribute allocations to modules.
+        """
+        if enabled in ('on', 'true', 'yes'):
+            if not memory.start_tracing():
+                event.msg.reply('tracemalloc is not available on this interpreter')
+                return
+            event.msg.reply('Tracing allocations, snapshots from now on will include modules')
+        else:
+            memory.stop_tracing()
+            event.msg.reply('Stopped tracing allocations')
+
+    def delete_messages(self, channel, message_ids, progress=None):
+        """
+        Deletes messages from a channel. Messages young enough to be bulk
+        deleted go in batches of up to 100, older ones (or all of them, without
+        Manage Messages) are deleted one by one, a few at a time. `progress` is
+        called with (deleted, failed) as batches complete. Returns the same.
+        """
+        cutoff = time.time() - self.BULK_DELETE_MAX_AGE
+        can_bulk = not channel.is_dm and channel.can(self.state.me, Permissions.MANAGE_MESSAGES)
+
+        bulk, single = [], []
+        for message_id in message_ids:
+            (bulk if can_bulk and to_unix(message_id) > cutoff else single).append(message_id)
+
+        batches = [bulk[idx:idx + self.BULK_DELETE_LIMIT] for idx in range(0, len(bulk), self.BULK_DELETE_LIMIT)]
+
+        # Bulk deletes take at least two messages
+        if batches and len(batches[-1]) == 1:
+            single.extend(batches.pop())
+
+        counts = {'deleted': 0, 'failed': 0}
+
+        def report():
+            if progress:
+                progress(counts['deleted'], counts['failed'])
+
+        for batch in batches:
+            try:
+                self.client.api.channels_messages_delete_bulk(channel.id, batch)
+                counts['deleted'] += len(batch)
+            except APIException:
+                self.log.exception('Failed to bulk delete %s messages in %s, retrying individually: ',
+                    len(batch), channel.id)
+                single.extend(batch)
+            report()
+
+        def delete_one(message_id):
+            try:
+                self.client.api.channels_messages_delete(channel.id, message_id)
+                return True
+            except APIException:
+                return False
+
+        pool = Pool(self.CLEAN_CONCURRENCY)
+        for idx, deleted in enumerate(pool.imap_unordered(delete_one, single), 1):
+            counts['deleted' if deleted else 'failed'] += 1
+            if idx % self.CLEAN_CONCURRENCY == 0:
+                report()
+
+        return counts['deleted'], counts['failed']
+
     @Plugin.command('clean', '[size:int] [mode:str]', level=CommandLevels.TRUSTED)
     def clean(self, event, size=10, mode=None):
-        if len(self.state.messages[event.channel.id]) < self.state.messages[event.channel.id].maxlen:
-            self.state.fill_messages(event.channel)
-
         if mode in ('any', 'all'):
-            msgs = take(reversed(self.state.messages[event.channel.id]), size)
+            if len(self.state.messages[event.channel.id]) < self.state.messages[event.channel.id].maxlen:
+                self.state.fill_messages(event.channel)
+            message_ids = [i.id for i in take(reversed(self.state.messages[event.channel.id]), size)]
         else:
-            msgs = take(reversed([
-                i for i in self.state.messages[event.channel.id]
-                if i.author_id == self.state.me.id]), size)
-
-        msgs = list(msgs)
-        msg = event.msg.reply('Deleting {} messages...'.format(len(msgs)))
-        event.channel.delete_messages(msgs)
-        gevent.sleep(5)
-        msg.delete()
+            index = self.own_messages[event.channel.id]
+
+            # Seed the index from the message cache if it doesn't go back far
+            #  enough (e.g. the bot restarted since it last posted here)
+            if len(index) < size:
+                if len(self.state.messages[event.channel.id]) < self.state.messages[event.channel.id].maxlen:
+                    self.state.fill_messages(event.channel)
+                ids = set(index) | set(
+                    i.id for i in self.state.messages[event.channel.id]
+                    if i.author_id == self.state.me.id)
+                self.own_messages[event.channel.id] = index = deque(sorted(ids), index.maxlen)
+
+            message_ids = list(take(reversed(index), size))
+
+        msg = event.msg.reply('Deleting {} messages...'.format(len(message_ids)))
+        last_update = [time.time()]
+
+        def progress(deleted, failed):
+            if time.time() - last_update[0] < self.CLEAN_PROGRESS_INTERVAL:
+                return
+            last_update[0] = time.time()
+            msg.edit('Deleting {} messages... {} done'.format(len(message_ids), deleted + failed))
+
+        deleted, failed = self.delete_messages(event.channel, message_ids, progress)
+
+        if failed:
+            msg.edit('Deleted {} messages, failed to delete {}'.format(deleted, failed))
+        else:
+            msg.edit('Deleted {} messages'.format(deleted))
+        gevent.spawn_later(5, msg.delete)
 
     @Plugin.command('plugins')
     def plugins(self, event):
@@ -201,13 +569,14 @@ class UtilPlugin(Plugin):
     @Plugin.command('reload', '<plugin:str>', level=CommandLevels.OWNER, oob=True)
     def on_reload(self, event, plugin):
         def reload_call(bot):
+            start = time.time()
             bot.plugins[plugin].reload()
+            return time.time() - start
 
-        if self.bot.shards:
-            self.bot.shards.all(reload_call)
-        else:
-            reload_call(self.bot)
-        event.msg.reply('Reloaded {}'.format(plugin))
+        timings = self.all_shards(reload_call)
+        event.msg.reply('Reloaded {} ({})'.format(plugin, ', '.join(
+            'shard {}: {}'.format(shard, fmt_duration(duration))
+            for shard, duration in sorted(timings.items()))))
 
     @Plugin.command('block', '<entity:user>', level=CommandLevels.OWNER)
     def block(self, event, entity):
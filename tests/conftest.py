@@ -0,0 +1,26 @@
+import pytest
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module of the code under test, only moving when
+    told to.
+    """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """
+    Returns a function replacing a module's `time` with a FakeClock, which it
+    returns.
+    """
+    def patch(module, now=600000.0):
+        clock = FakeClock(now)
+        monkeypatch.setattr(module, 'time', clock)
+        return clock
+    return patch
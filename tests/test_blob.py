@@ -0,0 +1,82 @@
+import random
+
+from plugins.blob import BKTree, EmojiIndex
+
+
+def brute_force(hashes, key, radius):
+    return sorted(
+        (BKTree.distance(key, phash), value) for value, phash in hashes.items()
+        if BKTree.distance(key, phash) <= radius)
+
+
+def test_bktree_empty():
+    assert list(BKTree().search(0, 64)) == []
+
+
+def test_bktree_search_matches_brute_force():
+    rng = random.Random(1)
+    tree = BKTree()
+    hashes = {}
+
+    base = rng.getrandbits(64)
+    for value in range(500):
+        # Half near one hash, so small radii have something to find
+        phash = base ^ (1 << rng.randrange(64)) if value % 2 else rng.getrandbits(64)
+        hashes[value] = phash
+        tree.add(phash, value)
+
+    for radius in (0, 1, 4, 16, 64):
+        for key in (base, rng.getrandbits(64)):
+            assert sorted(tree.search(key, radius)) == brute_force(hashes, key, radius)
+
+
+def test_bktree_shared_hash():
+    tree = BKTree()
+    tree.add(0b1010, 'a')
+    tree.add(0b1010, 'b')
+    tree.add(0b1011, 'c')
+
+    assert sorted(tree.search(0b1010, 0)) == [(0, 'a'), (0, 'b')]
+    assert sorted(tree.search(0b1010, 1)) == [(0, 'a'), (0, 'b'), (1, 'c')]
+
+
+def test_bktree_discard():
+    tree = BKTree()
+    for value, phash in enumerate((0, 1, 3, 7, 15)):
+        tree.add(phash, value)
+
+    tree.discard(3, 2)
+    assert sorted(tree.search(0, 64)) == [(0, 0), (1, 1), (3, 3), (4, 4)]
+
+    # Values below a discarded one are still reachable
+    assert list(tree.search(15, 0)) == [(0, 4)]
+
+    # Discarding something that isn't there is a no-op
+    tree.discard(3, 2)
+    tree.discard(1 << 40, 9)
+    assert len(list(tree.search(0, 64))) == 4
+
+
+def test_emoji_index_nearest():
+    index = EmojiIndex()
+    index.add(1, 0b0000)
+    index.add(2, 0b0111)
+
+    assert index.nearest(0b0001, 4) == (1, 1)
+    assert index.nearest(0b0011, 4) == (1, 2)
+    assert index.nearest(0xff << 8, 4) is None
+
+
+def test_emoji_index_remove():
+    index = EmojiIndex()
+    index.add(1, 0b0000)
+    index.add(2, 0b0001)
+
+    index.remove(1)
+    assert len(index) == 1
+    assert index.nearest(0, 4) == (1, 2)
+
+    index.remove(2)
+    index.remove(3)
+    assert len(index) == 0
+    assert index.nearest(0, 64) is None
@@ -0,0 +1,124 @@
+import random
+
+from plugins import metrics
+from plugins.metrics import HyperLogLog, RateCounter
+
+
+def test_hyperloglog_empty():
+    assert len(HyperLogLog()) == 0
+
+
+def test_hyperloglog_small_range_is_near_exact():
+    sketch = HyperLogLog()
+    sketch.update(range(1, 101))
+    assert 98 <= len(sketch) <= 102
+
+
+def test_hyperloglog_ignores_duplicates():
+    sketch = HyperLogLog()
+    for _ in range(5):
+        sketch.update(range(1000))
+    assert abs(len(sketch) - 1000) <= 30
+
+
+def test_hyperloglog_large_range():
+    rng = random.Random(1)
+    sketch = HyperLogLog()
+    sketch.update(rng.getrandbits(63) for _ in range(100000))
+    assert abs(len(sketch) - 100000) <= 5000
+
+
+def test_hyperloglog_merge_is_union():
+    left, right = HyperLogLog(), HyperLogLog()
+    left.update(range(0, 6000))
+    right.update(range(4000, 10000))
+
+    left.merge(right)
+    assert abs(len(left) - 10000) <= 500
+
+
+def test_hyperloglog_dumps_loads():
+    sketch = HyperLogLog()
+    sketch.update(range(5000))
+
+    data = sketch.dumps()
+    assert isinstance(data, bytes)
+    assert len(data) == 1 << 12
+
+    loaded = HyperLogLog.loads(data)
+    assert loaded.registers == sketch.registers
+    assert len(loaded) == len(sketch)
+
+
+def rate_counter(fake_clock):
+    clock = fake_clock(metrics)
+    return RateCounter(), clock
+
+
+def test_rate_counter_rates(fake_clock):
+    counter, clock = rate_counter(fake_clock)
+
+    for second in range(10):
+        counter.hit(5)
+        clock.now += 1
+
+    assert counter.rate(10) == 5
+    assert counter.rate(60) == 50 / 60.0
+    assert counter.total == 50
+
+
+def test_rate_counter_second_rollover(fake_clock):
+    counter, clock = rate_counter(fake_clock)
+
+    counter.hit(30)
+    clock.now += 1
+    counter.hit(3)
+
+    clock.now += 61
+    assert counter.rate(60) == 0
+    assert list(counter.seconds) == [0] * RateCounter.SECONDS
+
+    counter.hit(2)
+    clock.now += 1
+    assert counter.rate(10) == 0.2
+
+    total, current, _, _, _, peak = counter.snapshot()
+    assert (total, current, peak) == (35, 0.2, 30)
+
+
+def test_rate_counter_minute_rollover(fake_clock):
+    counter, clock = rate_counter(fake_clock)
+
+    for minute in range(5):
+        counter.hit(60)
+        clock.now += 60
+
+    assert counter.minute_rate(5) == 1
+    assert counter.minute_rate(15) == 5 * 60 / 900.0
+
+    clock.now += 15 * 60 + 1
+    assert counter.minute_rate(15) == 0
+    assert list(counter.minutes) == [0] * RateCounter.MINUTES
+    assert counter.total == 300
+
+
+def test_rate_counter_peak(fake_clock):
+    counter, clock = rate_counter(fake_clock)
+
+    counter.hit(50)
+    clock.now += 1
+    for second in range(5):
+        counter.hit(5)
+        clock.now += 1
+
+    assert counter.snapshot()[5] == 50
+
+    # The peak outlives the windows it was seen in
+    clock.now += 61
+    assert counter.snapshot()[5] == 50
+    clock.now += 16 * 60
+    assert counter.snapshot()[5] == 50
+
+    # The current (incomplete) second counts towards it
+    counter.hit(80)
+    assert counter.snapshot()[5] == 80
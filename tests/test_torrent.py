@@ -0,0 +1,64 @@
+from plugins import torrent
+from plugins.torrent import TTLCache, normalize_query
+
+
+def ttl_cache(fake_clock, max_size=3, ttl=60):
+    clock = fake_clock(torrent)
+    return TTLCache(max_size, ttl), clock
+
+
+def test_ttl_cache_hit_and_miss(fake_clock):
+    cache, _ = ttl_cache(fake_clock)
+
+    assert cache.get('a') is None
+    cache.set('a', [1])
+    assert cache.get('a') == [1]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttl_cache_expiry(fake_clock):
+    cache, clock = ttl_cache(fake_clock)
+    cache.set('a', [1])
+
+    clock.now += 60
+    assert cache.get('a') == [1]
+
+    # Reading doesn't extend the TTL, and expired entries are dropped
+    clock.now += 1
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+    # Setting again starts a new TTL
+    cache.set('a', [2])
+    clock.now += 30
+    assert cache.get('a') == [2]
+
+
+def test_ttl_cache_lru_eviction(fake_clock):
+    cache, _ = ttl_cache(fake_clock)
+    for key in 'abc':
+        cache.set(key, key)
+
+    # Using a makes b the least recently used
+    assert cache.get('a') == 'a'
+    cache.set('d', 'd')
+
+    assert len(cache) == 3
+    assert cache.evictions == 1
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acd'] == ['a', 'c', 'd']
+
+
+def test_ttl_cache_replace(fake_clock):
+    cache, _ = ttl_cache(fake_clock)
+    for key in 'abc':
+        cache.set(key, key)
+
+    cache.set('a', 'A')
+    assert len(cache) == 3
+    assert cache.evictions == 0
+    assert cache.get('a') == 'A'
+
+
+def test_normalize_query():
+    assert normalize_query('  Some  Show\tS01 ') == 'some show s01'